@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+SQLite backed stand-in of aiomysql pool for benchmarks and local tests.
+
+Implements the parts of aiomysql used by orm: create_pool, acquire /
+release, 'with (yield from pool) as conn', conn.cursor(cls), begin /
+commit / rollback, cursor execute, fetchone / fetchmany / fetchall and
+rowcount. An optional latency is added to every statement to stand in for
+the network round trip to MySQL.
+'''
+
+import asyncio, sqlite3, logging
+
+def create_database(models, path=':memory:'):
+    '''
+    Create sqlite database with tables of models, indexed like schema.sql.
+    '''
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    for model in models:
+        columns = []
+        for name, field in model.__mappings__.items():
+            columns.append('`%s` %s%s' % (name, field.column_type, ' primary key' if field.primary_key else ''))
+        db.execute('create table `%s` (%s)' % (model.__table__, ', '.join(columns)))
+        if 'created_at' in model.__mappings__:
+            db.execute('create index `idx_%s_created_at` on `%s` (`created_at`)' % (model.__table__, model.__table__))
+    return db
+
+class Cursor(object):
+
+    def __init__(self, conn, dict_rows):
+        self._conn = conn
+        self._dict_rows = dict_rows
+        self._cur = None
+        self.rowcount = -1
+
+    def _rows(self, rs):
+        if not self._dict_rows:
+            return rs
+        names = [d[0] for d in self._cur.description]
+        return [dict(zip(names, r)) for r in rs]
+
+    @asyncio.coroutine
+    def execute(self, sql, args=()):
+        yield from self._conn._roundtrip()
+        self._cur = self._conn._db.execute(sql.replace('%s', '?'), tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+        return self.rowcount
+
+    @asyncio.coroutine
+    def fetchone(self):
+        rs = self._rows(self._cur.fetchmany(1))
+        return rs[0] if rs else None
+
+    @asyncio.coroutine
+    def fetchmany(self, size=None):
+        return self._rows(self._cur.fetchmany(size or 1))
+
+    @asyncio.coroutine
+    def fetchall(self):
+        return self._rows(self._cur.fetchall())
+
+    @asyncio.coroutine
+    def close(self):
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+
+class Connection(object):
+
+    def __init__(self, pool, db, latency):
+        self._pool = pool
+        self._db = db
+        self._latency = latency
+        self.closed = False
+
+    @asyncio.coroutine
+    def _roundtrip(self):
+        if self._latency:
+            yield from asyncio.sleep(self._latency)
+
+    @asyncio.coroutine
+    def cursor(self, cursor_class=None):
+        # DictCursor and SSDictCursor return dicts, Cursor and SSCursor tuples:
+        name = getattr(cursor_class, '__name__', '')
+        return Cursor(self, 'Dict' in name)
+
+    @asyncio.coroutine
+    def begin(self):
+        yield from self._roundtrip()
+        self._db.execute('begin')
+
+    @asyncio.coroutine
+    def commit(self):
+        yield from self._roundtrip()
+        self._db.execute('commit')
+
+    @asyncio.coroutine
+    def rollback(self):
+        yield from self._roundtrip()
+        self._db.execute('rollback')
+
+    def close(self):
+        self.closed = True
+
+class _ContextManager(object):
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, *args):
+        self._pool.release(self._conn)
+
+class Pool(object):
+
+    def __init__(self, db, minsize=1, maxsize=10, latency=0, loop=None):
+        self._db = db
+        self._latency = latency
+        self._free = [Connection(self, db, latency) for i in range(minsize)]
+        self._sem = asyncio.Semaphore(maxsize)
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.size = minsize
+        self._closed = False
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    @asyncio.coroutine
+    def acquire(self):
+        yield from self._sem.acquire()
+        if self._free:
+            return self._free.pop()
+        self.size = self.size + 1
+        return Connection(self, self._db, self._latency)
+
+    def release(self, conn):
+        self._free.append(conn)
+        self._sem.release()
+
+    def __iter__(self):
+        conn = yield from self.acquire()
+        return _ContextManager(self, conn)
+
+    def close(self):
+        self._closed = True
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        for conn in self._free:
+            conn.close()
+        self._free = []
+
+def pool_factory(db, latency=0):
+    '''
+    Return a coroutine function with the signature of aiomysql.create_pool,
+    which creates Pool over db regardless of host / user / password.
+    '''
+    @asyncio.coroutine
+    def create_pool(minsize=1, maxsize=10, loop=None, **kw):
+        logging.info('create sqlite stand-in pool: minsize %s, maxsize %s, latency %s' % (minsize, maxsize, latency))
+        return Pool(db, minsize, maxsize, latency, loop)
+    return create_pool
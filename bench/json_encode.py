@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+Compare JSON encoding paths of response_factory on an api_comments payload.
+
+Usage: python3 bench/json_encode.py [comments] [rounds]
+'''
+
+import os, sys, time, json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+import serializer
+from apis import Page
+from models import Comment, next_id
+
+def make_payload(n):
+    comments = []
+    for i in range(n):
+        comments.append(Comment(id=next_id(), blog_id=next_id(), user_id=next_id(), user_name=u'用户%s' % i, user_image='http://www.gravatar.com/avatar/%s' % i, content=u'评论内容 comment %s ' % i * 5, created_at=time.time()))
+    names = Comment._columnNames(frozenset())
+    tuples = [tuple(c[k] for k in names) for c in comments]
+    rows = Comment.__row__.fromTuples(names, tuples)
+    records = [Comment.__record__(zip(names, t)) for t in tuples]
+    return dict(page=Page(n, 1, n), comments=comments), dict(page=Page(n, 1, n), comments=rows), dict(page=Page(n, 1, n), comments=records)
+
+def timeit(fn, rounds):
+    fn()
+    start = time.perf_counter()
+    for i in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1000
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    models, rows, records = make_payload(n)
+    paths = [
+        ('json.dumps (before)', lambda: json.dumps(models, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')),
+        ('serializer.dumps', lambda: serializer.dumps(models)),
+        ('serializer.dumps rows', lambda: serializer.dumps(rows)),
+        ('serializer.dumps records', lambda: serializer.dumps(records)),
+        ('serializer.iterdumps', lambda: b''.join(serializer.iterdumps(models))),
+    ]
+    print('encoder: %s, comments: %s' % ('orjson' if serializer.orjson else 'json', n))
+    for label, fn in paths:
+        print('%-24s %.2f ms' % (label, timeit(fn, rounds)))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+Load test of the web app against the SQLite stand-in of MySQL.
+
+Boots app.init with fakedb instead of aiomysql, seeds users, blogs and
+comments, drives the real routes with a concurrent client and reports
+requests per second, latency percentiles and allocated memory per request
+of every route. Results are written as JSON, and compared with a previous
+run if --compare is given.
+
+Usage: python3 bench/load.py --blogs 1000 --comments 10 --out baseline.json
+'''
+
+import os, sys, time, json, random, hashlib, argparse, asyncio, logging, platform, tempfile, tracemalloc
+
+WWW = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www')
+sys.path.insert(0, WWW)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakedb
+
+PASSWORD = 'benchmark'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the web app against a local MySQL stand-in.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--blogs', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=10, help='comments per blog')
+    parser.add_argument('--requests', type=int, default=500, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0005, help='seconds added per statement')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--replicas', type=int, default=0, help='stand-in replica pools over the same database')
+    parser.add_argument('--no-cache', action='store_true', help='disable query, page, html and session caches')
+    parser.add_argument('--no-alloc', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--out', default=None, help='write results as JSON to this file')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run')
+    return parser.parse_args()
+
+def seed(db, args):
+    '''
+    Insert users, blogs and comments straight into sqlite, return ids to request.
+    '''
+    from models import next_id
+    now = time.time()
+    users = []
+    for i in range(args.users):
+        uid = next_id()
+        email = 'user%s@example.com' % i
+        passwd = hashlib.sha1(('%s:%s' % (email, PASSWORD)).encode('utf-8')).hexdigest()
+        stored = hashlib.sha1(('%s:%s' % (uid, passwd)).encode('utf-8')).hexdigest()
+        users.append((uid, email, stored, i == 0, 'user%s' % i, 'http://www.gravatar.com/avatar/%s' % i, now - i))
+    db.executemany('insert into users (id, email, passwd, admin, name, image, created_at) values (?, ?, ?, ?, ?, ?, ?)', users)
+    words = ['python', 'asyncio', 'mysql', 'aiohttp', '数据库', '异步', '网络', '教程', 'jinja2', 'markdown']
+    blogs = []
+    comments = []
+    for i in range(args.blogs):
+        user = users[i % len(users)]
+        bid = next_id()
+        name = ' '.join(random.sample(words, 3))
+        paragraphs = ['## %s\n\n%s\n\n```\nprint(%s)\n```' % (random.choice(words), ' '.join(random.choice(words) for _ in range(80)), i) for _ in range(10)]
+        blogs.append((bid, user[0], user[4], user[5], name, 'summary of %s' % name, '\n\n'.join(paragraphs), now - i * 60, False))
+        for j in range(args.comments):
+            u = users[(i + j) % len(users)]
+            comments.append((next_id(), bid, u[0], u[4], u[5], 'comment %s of %s' % (j, name), now - i * 60 + j))
+    db.executemany('insert into blogs (id, user_id, user_name, user_image, name, summary, content, created_at, private_blogs) values (?, ?, ?, ?, ?, ?, ?, ?, ?)', blogs)
+    db.executemany('insert into comments (id, blog_id, user_id, user_name, user_image, content, created_at) values (?, ?, ?, ?, ?, ?, ?)', comments)
+    return dict(blogs=[b[0] for b in blogs], words=words, email=users[0][1], passwd=hashlib.sha1(('%s:%s' % (users[0][1], PASSWORD)).encode('utf-8')).hexdigest())
+
+def routes(data):
+    '''
+    (name, method, path factory, json body) of routes to drive.
+    '''
+    blogs = data['blogs']
+    return [
+        ('index', 'GET', lambda: '/?page=%s' % random.randint(1, 5), None),
+        ('blog', 'GET', lambda: '/blog/%s' % random.choice(blogs), None),
+        ('api_blogs', 'GET', lambda: '/api/blogs?page=%s' % random.randint(1, 50), None),
+        ('authenticate', 'POST', lambda: '/api/authenticate', dict(email=data['email'], passwd=data['passwd'])),
+        ('search', 'GET', lambda: '/search/name/%s' % random.choice(data['words']), None),
+    ]
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+@asyncio.coroutine
+def request(session, base, method, path, body):
+    start = time.perf_counter()
+    if body is None:
+        resp = yield from session.request(method, base + path)
+    else:
+        resp = yield from session.request(method, base + path, data=json.dumps(body), headers={'Content-Type': 'application/json'})
+    yield from resp.read()
+    resp.release()
+    return time.perf_counter() - start, resp.status
+
+@asyncio.coroutine
+def drive(session, base, route, n, concurrency):
+    name, method, path, body = route
+    latencies = []
+    errors = [0]
+    queue = list(range(n))
+    @asyncio.coroutine
+    def client():
+        while queue:
+            queue.pop()
+            elapsed, status = yield from request(session, base, method, path(), body)
+            latencies.append(elapsed)
+            if status >= 400:
+                errors[0] = errors[0] + 1
+    start = time.perf_counter()
+    yield from asyncio.gather(*[client() for i in range(concurrency)])
+    total = time.perf_counter() - start
+    return dict(requests=n, errors=errors[0], rps=round(n / total, 1),
+        p50_ms=round(percentile(latencies, 50) * 1000, 3), p95_ms=round(percentile(latencies, 95) * 1000, 3), p99_ms=round(percentile(latencies, 99) * 1000, 3))
+
+@asyncio.coroutine
+def trace_allocations(session, base, route, n):
+    ' average peak of traced memory per request, requests are sent one by one. '
+    name, method, path, body = route
+    total = 0
+    for i in range(n):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        yield from request(session, base, method, path(), body)
+        total = total + tracemalloc.get_traced_memory()[1] - current
+    return round(total / n / 1024, 2)
+
+def compare(results, path):
+    with open(path) as fp:
+        old = json.load(fp)
+    print('\ncompared with %s:' % path)
+    for name, r in results['routes'].items():
+        o = old['routes'].get(name)
+        if o is None:
+            continue
+        deltas = []
+        for key in ('rps', 'p50_ms', 'p99_ms', 'alloc_kb'):
+            if o.get(key) and r.get(key) is not None:
+                deltas.append('%s %+.1f%%' % (key, (r[key] - o[key]) * 100.0 / o[key]))
+        print('%-14s %s' % (name, ', '.join(deltas)))
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    from config import configs
+    configs.server.port = args.port
+    configs.server.workers = 1
+    configs.search.path = os.path.join(tempfile.mkdtemp(), 'search.idx')
+    configs.db.replicas = [dict(host='replica%s' % i) for i in range(args.replicas)]
+    if args.no_cache:
+        configs.cache.query_maxsize = 0
+        configs.cache.page_maxsize = 0
+        configs.cache.html_maxsize = 0
+        configs.cache.session_maxsize = 0
+    import aiomysql, models
+    db = fakedb.create_database([models.User, models.Blog, models.Comment])
+    data = seed(db, args)
+    aiomysql.create_pool = fakedb.pool_factory(db, args.latency)
+    import app, aiohttp
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    srv, handler = loop.run_until_complete(app.init(loop))
+    base = 'http://%s:%s' % (configs.server.host, configs.server.port)
+    results = dict(meta=dict(users=args.users, blogs=args.blogs, comments=args.comments, requests=args.requests, concurrency=args.concurrency,
+        latency=args.latency, replicas=args.replicas, cache=not args.no_cache, python=platform.python_version(), time=time.strftime('%Y-%m-%d %H:%M:%S')), routes=dict())
+    @asyncio.coroutine
+    def run():
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency))
+        try:
+            for route in routes(data):
+                # warm up caches and templates:
+                yield from drive(session, base, route, min(args.requests, args.concurrency), args.concurrency)
+                r = yield from drive(session, base, route, args.requests, args.concurrency)
+                if not args.no_alloc:
+                    tracemalloc.start()
+                    r['alloc_kb'] = yield from trace_allocations(session, base, route, min(args.requests, 50))
+                    tracemalloc.stop()
+                results['routes'][route[0]] = r
+                print('%-14s rps %8.1f  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  alloc %s kb  errors %s' % (route[0], r['rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r.get('alloc_kb', '-'), r['errors']))
+        finally:
+            yield from session.close()
+    loop.run_until_complete(run())
+    loop.run_until_complete(app.shutdown(srv, handler))
+    if args.out:
+        with open(args.out, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+        print('results written to %s' % args.out)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__=='__main__':
+    main()
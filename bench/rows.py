@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+Compare dict based Model objects and compact __slots__ rows built by findAll.
+
+Usage: python3 bench/rows.py [rows]
+'''
+
+import os, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+from models import Comment, next_id
+
+def make_rows(n):
+    names = Comment._columnNames(frozenset())
+    rows = []
+    for i in range(n):
+        rows.append((next_id(), next_id(), next_id(), 'user%s' % i, 'http://www.gravatar.com/avatar/%s' % i, 'comment content %s' % i, time.time()))
+    return names, rows
+
+def build_models(names, rows):
+    dicts = [dict(zip(names, t)) for t in rows]   # what DictCursor returns
+    return [Comment._fromRow(r, frozenset()) for r in dicts]
+
+def build_compact(names, rows):
+    return Comment.__row__.fromTuples(names, rows)
+
+def measure(fn, names, rows):
+    start = time.perf_counter()
+    fn(names, rows)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    objs = fn(names, rows)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return elapsed, size
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    names, rows = make_rows(n)
+    for label, fn in (('Model', build_models), ('compact', build_compact)):
+        elapsed, size = measure(fn, names, rows)
+        print('%-8s rows: %s, build: %.2f ms, memory: %s bytes/row' % (label, n, elapsed * 1000, size // n))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+Compare building select sql of findAll and parsing statements on every
+call with the memoized query shapes and statements of orm.
+
+Usage: python3 bench/statements.py [calls]
+'''
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+import orm
+from models import Blog
+
+def find_page(n, clear):
+    for i in range(n):
+        if clear:
+            orm._shapes.clear()
+            orm._statements.clear()
+        sql, args, deferred, reverse = Blog._selectSql(None, None, dict(orderBy='created_at desc', limit=(i, 10)))
+        orm._statement(sql)
+
+def measure(n, clear):
+    start = time.perf_counter()
+    find_page(n, clear)
+    return time.perf_counter() - start
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for label, clear in (('rebuilt', True), ('cached', False)):
+        elapsed = measure(n, clear)
+        print('%-8s calls: %s, total: %.2f ms, per call: %.2f us' % (label, n, elapsed * 1000, elapsed * 1000000 / n))
+
+if __name__=='__main__':
+    main()
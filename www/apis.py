@@ -53,6 +53,21 @@ class Page(object):
             self.limit = self.page_size
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    def set_cursors(self, items):
+        '''
+        Set next_cursor and previous_cursor by the items of current page.
+
+        Items must provide getCursor(reverse), e.g. orm.Model objects.
+        '''
+        if not items:
+            return
+        if self.has_next:
+            self.next_cursor = items[-1].getCursor()
+        if self.has_previous:
+            self.previous_cursor = items[0].getCursor(True)
 
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
@@ -9,18 +9,22 @@ async web application.
 
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, time, gzip, zlib, signal, functools
 from datetime import datetime
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateError
 
 from config import configs
 
-import orm
-from coroweb import add_routes, add_static
+import orm, serializer
+from cache import LRUCache
+from compress import compressible, choose_encoding, compress
+from coroweb import add_routes, add_static, make_etag, http_date, not_modified
 
-from handlers import cookie2user, COOKIE_NAME
+from workers import Master, attach, heartbeat, publish, subscribe
+
+from handlers import cookie2user, init_search_index, save_search_index, refresh_search_index, COOKIE_NAME
 
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
@@ -37,11 +41,26 @@ def init_jinja2(app, **kw):
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
         #path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test')
     logging.info('set jinja2 template path: %s' % path)
+    bytecode_cache = kw.get('bytecode_cache', None)
+    if bytecode_cache:
+        # compiled templates shared by workers and kept across restarts:
+        os.makedirs(bytecode_cache, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
+        logging.info('set jinja2 bytecode cache: %s' % bytecode_cache)
     env = Environment(loader=FileSystemLoader(path), **options)
     filters = kw.get('filters', None)
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    if kw.get('precompile', False):
+        # load all templates now, so first requests do not compile them:
+        names = env.list_templates(extensions=['html'])
+        for name in names:
+            try:
+                env.get_template(name)
+            except TemplateError as e:
+                logging.error('can not compile template %s: %s' % (name, e))
+        logging.info('precompiled %s templates' % len(names))
     app['__templating__'] = env
 
 @asyncio.coroutine
@@ -53,6 +72,155 @@ def logger_factory(app, handler):
         return (yield from handler(request))
     return logger
 
+# compressed responses of anonymous GET, see coroweb.cache_page:
+_page_cache = LRUCache(configs.cache.page_maxsize)
+
+def purge_page_cache(table):
+    if table in ('blogs', 'comments'):
+        _page_cache.clear()
+
+def page_cached(request):
+    ' True if page_cache_factory serves or stores the response of request. '
+    return (configs.cache.page_maxsize > 0 and request.method == 'GET' and not request.cookies.get(COOKIE_NAME)
+        and bool(getattr(request.match_info.handler, '__cache_ttl__', None)))
+
+@asyncio.coroutine
+def page_cache_factory(app, handler):
+    @asyncio.coroutine
+    def page_cache(request):
+        if not page_cached(request):
+            return (yield from handler(request))
+        ttl = request.match_info.handler.__cache_ttl__
+        key = request.path_qs
+        hit = _page_cache.get(key)
+        if hit is None:
+            r = yield from handler(request)
+            if type(r) is not web.Response or r.status != 200 or 'Set-Cookie' in r.headers or r.body is None:
+                return r
+            hit = (r.headers['Content-Type'], compress(r.body, 'gzip', configs.compress.gzip_level), r.headers.get('ETag') or make_etag(r.body))
+            _page_cache.set(key, hit, ttl=ttl)
+        else:
+            logging.info('page cache hit: %s' % key)
+        content_type, body, etag = hit
+        headers = {'Content-Type': content_type, 'Vary': 'Accept-Encoding, Cookie'}
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            # a strong ETag differs by encoding:
+            headers['ETag'] = etag[:-1] + '-gzip"'
+            if not_modified(request, headers['ETag']):
+                return web.HTTPNotModified(headers=dict(ETag=headers['ETag'], Vary=headers['Vary']))
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            headers['ETag'] = etag
+            if not_modified(request, etag):
+                return web.HTTPNotModified(headers=dict(ETag=etag, Vary=headers['Vary']))
+            body = gzip.decompress(body)
+        return web.Response(body=body, headers=headers)
+    return page_cache
+
+# (ETag of body, encoding) => compressed body:
+_compress_cache = LRUCache(configs.compress.cache_maxsize, 3600)
+
+@asyncio.coroutine
+def compress_factory(app, handler):
+    '''
+    Compress text responses of at least threshold bytes by gzip or brotli,
+    bodies are cached by their ETag.
+    '''
+    @asyncio.coroutine
+    def compression(request):
+        r = yield from handler(request)
+        if isinstance(r, web.Response) and r.status == 304 and 'ETag' in r.headers:
+            # answer with the ETag the client has, of the compressed body:
+            etag = r.headers['ETag']
+            if_none_match = request.headers.get('If-None-Match', '')
+            for encoding in ('gzip', 'br'):
+                tag = '%s-%s"' % (etag[:-1], encoding)
+                if tag in if_none_match:
+                    r.headers['ETag'] = tag
+                    break
+            return r
+        if type(r) is not web.Response or r.status != 200 or r.body is None or 'Content-Encoding' in r.headers:
+            return r
+        if len(r.body) < configs.compress.threshold or not compressible(r.content_type):
+            return r
+        add_vary(r.headers, 'Accept-Encoding')
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return r
+        etag = r.headers.get('ETag')
+        digest = None
+        if etag is not None or 'Set-Cookie' not in r.headers:
+            # an ETag of the handler may stay while the rendered body changes, cache by the body:
+            digest = make_etag(r.body)
+            etag = etag or digest
+        level = configs.compress.brotli_level if encoding == 'br' else configs.compress.gzip_level
+        body = _compress_cache.get((digest, encoding)) if digest else None
+        if body is None:
+            body = compress(r.body, encoding, level)
+            if digest:
+                _compress_cache.set((digest, encoding), body)
+        r.body = body
+        r.headers['Content-Encoding'] = encoding
+        if etag:
+            # a strong ETag differs by encoding:
+            r.headers['ETag'] = '%s-%s"' % (etag[:-1], encoding)
+        return r
+    return compression
+
+def route_cache_control(request):
+    '''
+    Cache-Control of route (see coroweb.cache_control), or None. Pages of
+    signed in users are revalidated every time, so they are not shown
+    from the browser cache after signing out.
+    '''
+    cache_control = getattr(request.match_info.handler, '__cache_control__', None)
+    if cache_control and request.cookies.get(COOKIE_NAME):
+        cache_control = 'private, no-cache'
+    return cache_control
+
+def add_vary(headers, name):
+    vary = headers.get('Vary')
+    if not vary:
+        headers['Vary'] = name
+    elif name not in vary:
+        headers['Vary'] = vary + ', ' + name
+
+@asyncio.coroutine
+def conditional_factory(app, handler):
+    '''
+    Add Cache-Control of route and ETag of body to GET responses, answer 304
+    if the client has them already.
+    '''
+    @asyncio.coroutine
+    def conditional(request):
+        r = yield from handler(request)
+        if request.method != 'GET' or type(r) is not web.Response or r.status != 200:
+            return r
+        cache_control = route_cache_control(request)
+        if cache_control and 'Cache-Control' not in r.headers:
+            r.headers['Cache-Control'] = cache_control
+            # signed in and anonymous responses differ:
+            add_vary(r.headers, 'Cookie')
+        if 'ETag' not in r.headers and r.body is not None and 'Set-Cookie' not in r.headers:
+            r.headers['ETag'] = make_etag(r.body)
+        if not_modified(request, r.headers.get('ETag')):
+            headers = dict((k, r.headers[k]) for k in ('ETag', 'Cache-Control', 'Last-Modified', 'Vary') if k in r.headers)
+            return web.HTTPNotModified(headers=headers)
+        return r
+    return conditional
+
+@asyncio.coroutine
+def scope_factory(app, handler):
+    @asyncio.coroutine
+    def scope(request):
+        # identity map and find() batcher per request:
+        token = orm.open_scope()
+        try:
+            return (yield from handler(request))
+        finally:
+            orm.close_scope(token)
+    return scope
+
 @asyncio.coroutine
 def auth_factory(app, handler):
     @asyncio.coroutine
@@ -60,14 +228,19 @@ def auth_factory(app, handler):
         logging.info('check user: %s %s' % (request.method, request.path))
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
-        if cookie_str:
-            user = yield from cookie2user(cookie_str)
-            if user:
-                logging.info('set current user: %s' % user.email)
-                request.__user__ = user
-        if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
-            return web.HTTPFound('/signin')
-        return (yield from handler(request))
+        # reads after writes of this session go to primary database:
+        token = orm.open_session(cookie_str)
+        try:
+            if cookie_str:
+                user = yield from cookie2user(cookie_str)
+                if user:
+                    logging.info('set current user: %s' % user.email)
+                    request.__user__ = user
+            if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
+                return web.HTTPFound('/signin')
+            return (yield from handler(request))
+        finally:
+            orm.close_session(token)
     return auth
 
 @asyncio.coroutine
@@ -90,6 +263,28 @@ def response_factory(app, handler):
     def response(request):
         logging.info('Response handler...')
         r = yield from handler(request)
+        if not isinstance(r, dict) or ('__etag__' not in r and '__last_modified__' not in r):
+            return (yield from make_response(request, r))
+        # validators given by handler, answer 304 before rendering:
+        etag = None
+        if '__etag__' in r:
+            user = request.__user__
+            etag = make_etag(r.pop('__etag__'), user.id if user else '')
+        last_modified = r.pop('__last_modified__', None)
+        if not_modified(request, etag, last_modified):
+            return web.HTTPNotModified(headers=dict(ETag=etag) if etag else None)
+        headers = dict()
+        if etag:
+            headers['ETag'] = etag
+        if last_modified:
+            headers['Last-Modified'] = http_date(last_modified)
+        resp = yield from make_response(request, r, headers)
+        if type(resp) is web.Response:
+            resp.headers.update(headers)
+        return resp
+
+    @asyncio.coroutine
+    def make_response(request, r, headers=None):
         if isinstance(r, web.StreamResponse):
             return r
         if isinstance(r, bytes):
@@ -105,11 +300,23 @@ def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                if serializer.is_large(r):
+                    # large lists are written in chunks as they are encoded:
+                    resp = web.StreamResponse()
+                    resp.content_type = 'application/json;charset=utf-8'
+                    yield from resp.prepare(request)
+                    for chunk in serializer.iterdumps(r):
+                        yield from resp.write(chunk)
+                    yield from resp.write_eof()
+                    return resp
+                resp = web.Response(body=serializer.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
                 r['__user__'] = request.__user__
+                # pages for the page cache are rendered whole:
+                if r.pop('__stream__', False) and not page_cached(request):
+                    return (yield from stream_template(request, app['__templating__'].get_template(template), r, headers))
                 resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
@@ -125,6 +332,55 @@ def response_factory(app, handler):
         return resp
     return response
 
+@asyncio.coroutine
+def stream_template(request, template, kw, headers=None):
+    '''
+    Write template rendered by generate() to a StreamResponse: all up to
+    </head> at once, so browsers fetch css and js while the rest renders,
+    then in chunks of about configs.templates.stream_chunk bytes. Streamed
+    pages skip conditional_factory and compress_factory, so Cache-Control
+    and gzip are done here.
+    '''
+    resp = web.StreamResponse(headers=headers)
+    resp.content_type = 'text/html;charset=utf-8'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    cache_control = route_cache_control(request)
+    if cache_control:
+        resp.headers['Cache-Control'] = cache_control
+        add_vary(resp.headers, 'Cookie')
+    compressor = None
+    if configs.templates.stream_gzip and choose_encoding(request.headers.get('Accept-Encoding'), ('gzip',)) == 'gzip':
+        compressor = zlib.compressobj(configs.compress.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        resp.headers['Content-Encoding'] = 'gzip'
+        etag = resp.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            # body bytes differ by encoding:
+            resp.headers['ETag'] = 'W/' + etag
+    yield from resp.prepare(request)
+    @asyncio.coroutine
+    def flush(text):
+        data = text.encode('utf-8')
+        if compressor is not None:
+            # sync flush so the chunk is not held back in zlib:
+            data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield from resp.write(data)
+    buf = []
+    size = 0
+    head = True
+    for s in template.generate(**kw):
+        buf.append(s)
+        size = size + len(s)
+        if (head and '</head>' in s) or size >= configs.templates.stream_chunk:
+            head = False
+            yield from flush(''.join(buf))
+            buf = []
+            size = 0
+    yield from flush(''.join(buf))
+    if compressor is not None:
+        yield from resp.write(compressor.flush())
+    yield from resp.write_eof()
+    return resp
+
 def datetime_filter(t):
     delta = int(time.time() - t)
     if delta < 60:
@@ -139,18 +395,95 @@ def datetime_filter(t):
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 @asyncio.coroutine
-def init(loop):
-    yield from orm.create_pool(loop=loop, **configs.db)
+def init(loop, sock=None, workers=1):
+    db = dict(configs.db)
+    if workers > 1:
+        # every worker has its own pool, share the configured size among them:
+        db['maxsize'] = max(1, db.get('maxsize', 100) // workers)
+        db['minsize'] = min(db.get('minsize', 1), db['maxsize'])
+        db['replicas'] = [dict(r, maxsize=max(1, r['maxsize'] // workers)) if 'maxsize' in r else r for r in db.get('replicas', [])]
+    yield from orm.create_pool(loop=loop, **db)
+    orm.set_count_cache(ttl=configs.cache.count_ttl, approximate=configs.cache.count_approximate)
+    orm.set_slow_query(configs.db.slow_query, configs.db.explain_slow)
+    if configs.cache.query_maxsize > 0:
+        orm.set_query_cache(orm.MemoryQueryCache(configs.cache.query_maxsize, configs.cache.query_ttl))
+    orm.on_write(purge_page_cache)
+    if workers > 1:
+        # other workers drop their caches after writes of this one, and read from primary for the session:
+        orm.set_publisher(publish)
+        subscribe('write', lambda table: asyncio.ensure_future(orm.invalidate(table)))
+        subscribe('pin', lambda key: orm.pin_session(key, publish=False))
+    search_path = configs.search.path
+    if not os.path.isabs(search_path):
+        search_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), search_path)
+    yield from init_search_index(search_path)
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
+        logger_factory, conditional_factory, compress_factory, page_cache_factory, scope_factory, auth_factory, response_factory
     ])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    bytecode_cache = configs.templates.bytecode_cache
+    if bytecode_cache and not os.path.isabs(bytecode_cache):
+        bytecode_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), bytecode_cache)
+    # templates are reloaded when changed in debug mode only:
+    init_jinja2(app, filters=dict(datetime=datetime_filter), auto_reload=configs.debug, precompile=not configs.debug, bytecode_cache=bytecode_cache)
     add_routes(app, 'handlers')
     add_static(app)
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('server started at http://127.0.0.1:9000...')
-    return srv
+    handler = app.make_handler()
+    host, port = configs.server.host, configs.server.port
+    if sock is not None:
+        srv = yield from loop.create_server(handler, sock=sock)
+    else:
+        srv = yield from loop.create_server(handler, host, port, reuse_port=workers > 1)
+    logging.info('server started at http://%s:%s...' % (host, port))
+    return srv, handler
+
+@asyncio.coroutine
+def shutdown(srv, handler):
+    '''
+    Stop accepting, wait requests in flight, then close database pool.
+    '''
+    srv.close()
+    yield from srv.wait_closed()
+    yield from handler.shutdown(configs.server.shutdown_timeout)
+    yield from save_search_index()
+    yield from orm.close_pool()
+    logging.info('server stopped.')
+
+def run_worker(sock=None, notify=None, control=None, workers=1):
+    '''
+    Run one server process until SIGTERM, write heartbeats to notify fd and
+    read messages of other workers from control fd if given.
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if notify is not None:
+        attach(loop, notify, control)
+    srv, handler = loop.run_until_complete(init(loop, sock, workers))
+    def beat():
+        heartbeat()
+        loop.call_later(configs.server.heartbeat, beat)
+    def stop():
+        loop.remove_signal_handler(signal.SIGTERM)
+        task = asyncio.ensure_future(shutdown(srv, handler), loop=loop)
+        task.add_done_callback(lambda t: loop.stop())
+    if notify is not None:
+        beat()
+    if workers > 1:
+        loop.call_later(configs.search.save_delay, refresh_search_index, configs.search.save_delay)
+    loop.add_signal_handler(signal.SIGTERM, stop)
+    # kill -USR1 <pid> logs the statements taking most time:
+    loop.add_signal_handler(signal.SIGUSR1, orm.dump_statement_stats)
+    loop.run_forever()
+    loop.close()
+
+def main():
+    workers = configs.server.workers
+    if workers <= 1:
+        run_worker()
+        return
+    master = Master(functools.partial(run_worker, workers=workers), workers, configs.server.host, configs.server.port,
+        reuse_port=configs.server.reuse_port, heartbeat_timeout=configs.server.heartbeat_timeout,
+        shutdown_timeout=configs.server.shutdown_timeout, startup_timeout=configs.server.startup_timeout)
+    master.run()
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__=='__main__':
+    main()
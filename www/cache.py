@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+In-process LRU cache with TTL and tags.
+'''
+
+import time, collections
+
+class LRUCache(object):
+    '''
+    LRU cache bounded by maxsize, entries expire after ttl seconds.
+
+    Entries can carry tags, invalidate(tag) drops all entries of a tag.
+
+    >>> c = LRUCache(2, 60)
+    >>> c.set('a', 1, tags=('t',))
+    >>> c.set('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> c.invalidate('t')
+    >>> c.get('a') is None
+    True
+    >>> c.stats()['hits'], c.stats()['misses']
+    (1, 2)
+    '''
+
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._data = collections.OrderedDict()
+        self._tags = dict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, None, False) is not None
+
+    def get(self, key, default=None, count=True):
+        item = self._data.get(key)
+        if item is None or item[0] < time.time():
+            if item is not None:
+                self.delete(key)
+            if count:
+                self.misses = self.misses + 1
+            return default
+        self._data.move_to_end(key)
+        if count:
+            self.hits = self.hits + 1
+        return item[1]
+
+    def set(self, key, value, ttl=None, tags=()):
+        if self.maxsize <= 0:
+            return
+        if key in self._data:
+            self.delete(key)
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires, value, tuple(tags))
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self.delete(next(iter(self._data)))
+            self.evictions = self.evictions + 1
+
+    def delete(self, key):
+        item = self._data.pop(key, None)
+        if item is None:
+            return
+        for tag in item[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, tag):
+        ' drop all entries tagged by tag. '
+        keys = self._tags.pop(tag, ())
+        for key in list(keys):
+            self.delete(key)
+        self.invalidations = self.invalidations + 1
+
+    def clear(self):
+        self._data.clear()
+        self._tags.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses, evictions=self.evictions, invalidations=self.invalidations)
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
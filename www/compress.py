@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+gzip / brotli response compression.
+
+Uses brotli if installed, else only gzip. Run as a script to write .gz and
+.br siblings of static files, which add_static serves without compressing:
+
+    python3 compress.py [static dir]
+'''
+
+import os, sys, re, gzip, logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# text like content types worth compressing, fonts and images mostly are not:
+_RE_COMPRESSIBLE = re.compile(r'^(text/|application/(json|javascript|x-javascript|xml)|image/svg\+xml|application/vnd\.ms-fontobject|font/(ttf|otf))')
+
+STATIC_SUFFIXES = ('.js', '.css', '.html', '.svg', '.json', '.txt', '.xml', '.ttf', '.otf', '.eot')
+
+def compressible(content_type):
+    return content_type is not None and _RE_COMPRESSIBLE.match(content_type) is not None
+
+def choose_encoding(accept_encoding, encodings=None):
+    '''
+    Best of encodings (default all supported) accepted by Accept-Encoding
+    header, or None.
+
+    >>> choose_encoding('gzip, deflate')
+    'gzip'
+    >>> choose_encoding('gzip;q=0, identity') is None
+    True
+    >>> choose_encoding('br, gzip', ('gzip',))
+    'gzip'
+    '''
+    accepted = dict()
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    if encodings is None:
+        encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+def compress(data, encoding, level=6):
+    '''
+    Compress data by encoding ('gzip' or 'br'), level is 1-9 for gzip and
+    0-11 for brotli.
+
+    >>> gzip.decompress(compress(b'abc' * 100, 'gzip')) == b'abc' * 100
+    True
+    '''
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+def precompress(root, gzip_level=9, brotli_level=11):
+    '''
+    Write .gz (and .br if brotli is installed) siblings of static files
+    under root whose siblings are missing or older, return number written.
+    '''
+    encodings = [('gzip', '.gz', gzip_level)]
+    if brotli is not None:
+        encodings.append(('br', '.br', brotli_level))
+    n = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(STATIC_SUFFIXES):
+                continue
+            path = os.path.join(dirpath, name)
+            mtime = os.path.getmtime(path)
+            data = None
+            for encoding, suffix, level in encodings:
+                target = path + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                    continue
+                if data is None:
+                    with open(path, 'rb') as fp:
+                        data = fp.read()
+                body = compress(data, encoding, level)
+                if len(body) >= len(data):
+                    continue
+                with open(target, 'wb') as fp:
+                    fp.write(body)
+                n = n + 1
+                logging.info('compressed %s: %s => %s bytes' % (target, len(data), len(body)))
+    return n
+
+if __name__=='__main__':
+    logging.basicConfig(level=logging.INFO)
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    print('%s files written.' % precompress(root))
@@ -9,12 +9,68 @@ __author__ = 'Hellozmz'
 
 configs = {
     'debug': True,
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        'workers': 1,
+        'reuse_port': True,
+        'heartbeat': 5,
+        'heartbeat_timeout': 30,
+        # seconds a worker may take to start (e.g. to build the search index) before its first heartbeat:
+        'startup_timeout': 600,
+        'shutdown_timeout': 10
+    },
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': '123456',
-        'db': 'awesome'
+        'db': 'awesome',
+        'minsize': 5,
+        'maxsize': 100,
+        # p95 checkout wait (ms) to adapt number of connections in use to, 0 to use maxsize:
+        'target_wait': 0,
+        # log statements slower than this (ms), with EXPLAIN of slow selects if explain_slow:
+        'slow_query': 200,
+        'explain_slow': False,
+        # e.g. [{'host': '10.0.0.2'}], read by select() with least outstanding requests:
+        'replicas': [],
+        # seconds reads of a session go to primary after it writes:
+        'read_your_writes': 2
+    },
+    'cache': {
+        'count_ttl': 10,
+        'count_approximate': False,
+        'query_maxsize': 10000,
+        'query_ttl': 30,
+        'html_maxsize': 1000,
+        'html_ttl': 86400,
+        'html_persist': False,
+        'session_maxsize': 10000,
+        'session_ttl': 300,
+        'session_negative_ttl': 60,
+        'page_maxsize': 1000
+    },
+    'compress': {
+        # bodies smaller than threshold bytes are sent as is:
+        'threshold': 1024,
+        'gzip_level': 6,
+        'brotli_level': 5,
+        'cache_maxsize': 500
+    },
+    'templates': {
+        # directory of compiled templates, '' to compile in every process:
+        'bytecode_cache': '.jinja2cache',
+        # blog pages with this many comments are streamed while rendering, 0 to never:
+        'stream_comments': 200,
+        # bytes of html written at a time by a streamed page:
+        'stream_chunk': 16384,
+        # gzip streamed pages if the client accepts it:
+        'stream_gzip': True
+    },
+    'search': {
+        'path': 'search.idx',
+        'save_delay': 10
     },
     'session': {
         'secret': 'Xxxxxxx'
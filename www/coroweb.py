@@ -3,17 +3,29 @@
 
 __author__ = 'Hellozmz'
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, re, inspect, logging, functools, hashlib, mimetypes, contextvars
+
+from email.utils import formatdate, parsedate_to_datetime
 
 from urllib import parse
 
 from aiohttp import web
 
+import orm
+
 from apis import APIError
+from cache import LRUCache
+from compress import choose_encoding
 
-def get(path):
+def get(path, coalesce=False, max_waiters=1000):
     '''
     Define decorator @get('/path')
+
+    With coalesce=True, concurrent requests with the same args share one
+    call of the handler, see RequestHandler. The handler must not take
+    request, so its result only depends on its args. The shared call runs
+    outside any session, requests of a session pinned to primary after a
+    write (see orm.pin_session) call the handler on their own.
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -21,6 +33,7 @@ def get(path):
             return func(*args, **kw)
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__coalesce__ = max_waiters if coalesce else 0
         return wrapper
     return decorator
 
@@ -37,6 +50,78 @@ def post(path):
         return wrapper
     return decorator
 
+def cache_page(ttl):
+    '''
+    Define decorator @cache_page(ttl) to cache responses of anonymous GET for ttl seconds.
+    '''
+    def decorator(func):
+        func.__cache_ttl__ = ttl
+        return func
+    return decorator
+
+def cache_control(value):
+    '''
+    Define decorator @cache_control('public, max-age=60') to send Cache-Control
+    header with responses of the route, signed in users get 'private,
+    no-cache' instead.
+    '''
+    def decorator(func):
+        func.__cache_control__ = value
+        return func
+    return decorator
+
+def make_etag(*parts):
+    '''
+    Strong ETag of parts (str or bytes).
+
+    >>> make_etag('a', b'b')
+    '"5b4085401e259f3918fb1701d3d9399c2c8cce73"'
+    '''
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        h.update(b'\0')
+    return '"%s"' % h.hexdigest()
+
+def http_date(t):
+    return formatdate(t, usegmt=True)
+
+# suffix of ETags of compressed bodies, see app.compress_factory:
+_RE_ETAG_ENCODING = re.compile(r'-(?:gzip|br)"$')
+
+def strip_etag(tag):
+    '''
+    ETag for weak comparison: without W/ and the suffix of encoded bodies.
+
+    >>> strip_etag('W/"abc-gzip"')
+    '"abc"'
+    '''
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    return _RE_ETAG_ENCODING.sub('"', tag)
+
+def not_modified(request, etag=None, last_modified=None):
+    '''
+    True if the client copy is current: If-None-Match lists etag, or without
+    If-None-Match, If-Modified-Since is not before last_modified (a timestamp).
+    '''
+    if request.method != 'GET':
+        return False
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        tags = [strip_etag(t.strip()) for t in if_none_match.split(',')]
+        # weak comparison, as for GET, so the tag of a compressed body matches too:
+        return '*' in tags or strip_etag(etag) in tags
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
 def get_required_kw_args(fn):
     args = []
     params = inspect.signature(fn).parameters
@@ -77,7 +162,25 @@ def has_request_arg(fn):
             raise ValueError('request parameter must be the last named parameter in function: %s%s' % (fn.__name__, str(sig)))
     return found
 
+class Flight(object):
+    '''
+    A handler call shared by concurrent requests with the same args.
+    '''
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
 class RequestHandler(object):
+    '''
+    Call fn with args of request.
+
+    With coalescing (@get(path, coalesce=True)), a request whose args match a
+    call in flight waits for that call and gets its result (a copy, if it is
+    a dict) or its exception, so a burst of identical requests runs the
+    handler once. The call is shielded from cancel of waiting requests. At
+    most max_waiters requests wait for a call, more get 503.
+    '''
 
     def __init__(self, app, fn):
         self._app = app
@@ -87,6 +190,12 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        self._max_waiters = getattr(fn, '__coalesce__', 0)
+        if self._max_waiters and self._has_request_arg:
+            raise ValueError('coalesced handler can not take request: %s' % fn.__name__)
+        self._flights = dict()
+        self.__cache_ttl__ = getattr(fn, '__cache_ttl__', None)
+        self.__cache_control__ = getattr(fn, '__cache_control__', None)
 
     @asyncio.coroutine
     def __call__(self, request):
@@ -135,15 +244,87 @@ class RequestHandler(object):
                 if not name in kw:
                     return web.HTTPBadRequest('Missing argument: %s' % name)
         logging.info('call with args: %s' % str(kw))
+        # a session which just wrote must read its writes, not a shared result:
+        if self._max_waiters and request.method == 'GET' and not orm.is_pinned():
+            return (yield from self._coalesced(kw))
+        return (yield from self._call(kw))
+
+    @asyncio.coroutine
+    def _call(self, kw):
         try:
             r = yield from self._func(**kw)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
+    @asyncio.coroutine
+    def _flight(self, kw):
+        token = orm.open_scope()
+        try:
+            return (yield from self._call(kw))
+        finally:
+            orm.close_scope(token)
+
+    @asyncio.coroutine
+    def _coalesced(self, kw):
+        key = tuple(sorted(kw.items()))
+        flight = self._flights.get(key)
+        if flight is None:
+            # not in the context of the first request, its session and scope are not of the others:
+            flight = self._flights[key] = Flight(contextvars.Context().run(asyncio.ensure_future, self._flight(kw)))
+            def done(task):
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.task.add_done_callback(done)
+        elif flight.waiters >= self._max_waiters:
+            logging.warning('too many requests waiting for %s%s' % (self._func.__name__, str(kw)))
+            return web.HTTPServiceUnavailable()
+        else:
+            logging.info('coalesce call of %s with args: %s' % (self._func.__name__, str(kw)))
+        flight.waiters = flight.waiters + 1
+        try:
+            r = yield from asyncio.shield(flight.task)
+        finally:
+            flight.waiters = flight.waiters - 1
+        # the response middleware adds __user__ to dicts:
+        return dict(r) if type(r) is dict else r
+
+_static_cache = LRUCache(200, 60)
+
 def add_static(app):
+    '''
+    Serve files of www/static under /static/, as their .br or .gz sibling
+    written by compress.py if the client accepts it and it is up to date.
+    '''
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
+    root = os.path.realpath(path)
+    @asyncio.coroutine
+    def static(request):
+        filename = os.path.realpath(os.path.join(root, request.match_info['filename']))
+        if not filename.startswith(root + os.sep) or not os.path.isfile(filename):
+            raise web.HTTPNotFound()
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is not None:
+            target = filename + ('.br' if encoding == 'br' else '.gz')
+            try:
+                stat, mtime = os.stat(target), os.path.getmtime(filename)
+            except OSError:
+                stat = None
+            if stat is not None and stat.st_mtime >= mtime:
+                hit = _static_cache.get(target)
+                if hit is None or hit[0] != stat.st_mtime:
+                    with open(target, 'rb') as fp:
+                        hit = (stat.st_mtime, fp.read())
+                    _static_cache.set(target, hit)
+                etag = '"%x-%x-%s"' % (int(stat.st_mtime), stat.st_size, encoding)
+                headers = {'ETag': etag, 'Last-Modified': http_date(mtime), 'Vary': 'Accept-Encoding'}
+                if not_modified(request, etag, mtime):
+                    return web.HTTPNotModified(headers=headers)
+                headers['Content-Type'] = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                headers['Content-Encoding'] = encoding
+                return web.Response(body=hit[1], headers=headers)
+        return web.FileResponse(filename)
+    app.router.add_route('GET', '/static/{filename:.+}', static)
     logging.info('add static %s => %s' % ('/static/', path))
 
 def add_route(app, fn):
@@ -172,3 +353,7 @@ def add_routes(app, module_name):
             path = getattr(fn, '__route__', None)
             if method and path:
                 add_route(app, fn)
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -5,21 +5,161 @@ __author__ = 'Hellozmz'
 
 ' url handlers '
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, os, sys, time, logging, hashlib, asyncio
 
 import markdown2
+import orm, serializer
 
 from aiohttp import web
 
-from coroweb import get, post
-from apis import Page, APIError, APIValueError, APIResourceNotFoundError
+from coroweb import get, post, cache_page, cache_control, make_etag
+from apis import Page, APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
 
 from models import User, Comment, Blog, next_id
 from config import configs
+from cache import LRUCache
+from search import SearchIndex, lock_index, save_merged
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
 
+# rendered markdown of blogs, keyed by (blog id, sha1 of content) and tagged by blog id:
+_html_cache = LRUCache(configs.cache.html_maxsize, configs.cache.html_ttl)
+
+# users of session cookies (False for invalid cookies), keyed by cookie and tagged by user id:
+_session_cache = LRUCache(configs.cache.session_maxsize, configs.cache.session_ttl)
+
+def invalidate_sessions(uid=None):
+    '''
+    Drop cached sessions of user, or of all users if uid is None.
+    '''
+    if uid is None:
+        _session_cache.clear()
+    else:
+        _session_cache.invalidate(uid)
+
+def _on_write(table):
+    # users are written rarely (register, profile changes), drop all cached sessions:
+    if table == User.__table__:
+        invalidate_sessions()
+
+orm.on_write(_on_write)
+
+# full text index of blogs, see init_search_index():
+_search_index = SearchIndex()
+_search_path = None
+_search_save = None
+_search_mtime = None
+# changes of this process not saved yet, blog id => doc or None if removed:
+_search_changes = dict()
+_search_saving = False
+
+@asyncio.coroutine
+def init_search_index(path):
+    '''
+    Load search index from path, or build it from all blogs and save it there.
+    Workers take the lock of the index first, so one of them builds it and
+    the others load it when it is saved.
+    '''
+    global _search_index, _search_path, _search_mtime
+    _search_path = path
+    lock = yield from asyncio.get_event_loop().run_in_executor(None, lock_index, path)
+    try:
+        if os.path.exists(path):
+            try:
+                _search_mtime = os.path.getmtime(path)
+                _search_index = SearchIndex.load(path)
+                return
+            except Exception as e:
+                logging.exception(e)
+        idx = SearchIndex()
+        blogs = Blog.iterAll(defer=False)
+        try:
+            while True:
+                batch = yield from blogs.batch()
+                if not batch:
+                    break
+                for blog in batch:
+                    idx.add(blog.id, blog)
+        finally:
+            yield from blogs.close()
+        yield from asyncio.get_event_loop().run_in_executor(None, idx.save, path)
+        # reload to keep postings in the mmap rather than in memory:
+        _search_index = SearchIndex.load(path)
+        _search_mtime = os.path.getmtime(path)
+    finally:
+        lock.close()
+
+@asyncio.coroutine
+def save_search_index():
+    '''
+    Save search index if changed, from a snapshot in a thread so requests
+    are served meanwhile. Changes are merged into the index file if other
+    workers saved it since, see save_merged().
+    '''
+    global _search_index, _search_save, _search_saving, _search_mtime, _search_changes
+    if _search_save is not None:
+        _search_save.cancel()
+        _search_save = None
+    if not _search_path or not _search_index.dirty or _search_saving:
+        return
+    idx = _search_index.snapshot()
+    changes, _search_changes = _search_changes, dict()
+    _search_index.dirty = False
+    _search_saving = True
+    try:
+        saved, _search_mtime = yield from asyncio.get_event_loop().run_in_executor(None, save_merged, idx, changes, _search_path, _search_mtime)
+    except BaseException:
+        changes.update(_search_changes)
+        _search_changes = changes
+        _search_index.dirty = True
+        raise
+    finally:
+        _search_saving = False
+    if saved is not idx:
+        # merged with updates of other workers, keep changes made meanwhile:
+        for id, doc in _search_changes.items():
+            if doc is None:
+                saved.remove(id)
+            else:
+                saved.add(id, doc)
+        saved.dirty = bool(_search_changes)
+        _search_index = saved
+    if _search_index.dirty:
+        _schedule_search_save()
+
+def _schedule_search_save():
+    global _search_save
+    if _search_path and _search_save is None:
+        _search_save = asyncio.get_event_loop().call_later(configs.search.save_delay, lambda: asyncio.ensure_future(save_search_index()))
+
+def refresh_search_index(interval=None):
+    '''
+    Reload search index if another process saved a newer one, and call again after interval seconds.
+    '''
+    global _search_index, _search_mtime
+    try:
+        mtime = os.path.getmtime(_search_path)
+        if mtime != _search_mtime and not _search_index.dirty and not _search_saving:
+            _search_index = SearchIndex.load(_search_path)
+            _search_mtime = mtime
+    except Exception as e:
+        logging.exception(e)
+    if interval:
+        asyncio.get_event_loop().call_later(interval, refresh_search_index, interval)
+
+def index_blog(blog, remove=False):
+    '''
+    Update search index by new, edited or removed blog, and save it a while later.
+    '''
+    if remove:
+        _search_index.remove(blog.id)
+        _search_changes[blog.id] = None
+    else:
+        _search_index.add(blog.id, blog)
+        _search_changes[blog.id] = dict((f, blog.get(f)) for f in SearchIndex.FIELDS)
+    _schedule_search_save()
+
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
         raise APIPermissionError()
@@ -40,6 +180,40 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# pages of find_page() whose items are found while counting:
+PARALLEL_PAGES = 100
+
+@asyncio.coroutine
+def find_page(model, page_index, where=None, args=None, cursor=None, **kw):
+    '''
+    Count all items of model and find items of page (seek by cursor if given
+    else skip by offset), return (page, items). Both run concurrently up to
+    page PARALLEL_PAGES, later pages are found only if the count has them.
+    '''
+    def find(page):
+        if cursor:
+            return model.findAll(where, args, cursor=cursor, limit=page.limit, **kw)
+        return model.findAll(where, args, orderBy='created_at desc, id desc', limit=(page.offset, page.limit), **kw)
+    try:
+        if cursor or page_index <= PARALLEL_PAGES:
+            # offset and limit of page_index, as if it is in range:
+            num, items = yield from orm.gather(model.findNumber('count(id)'), find(Page(sys.maxsize, page_index)))
+        else:
+            num = yield from model.findNumber('count(id)')
+            items = None
+    except ValueError:
+        if cursor:
+            raise APIValueError('cursor', 'Invalid cursor.')
+        raise
+    page = Page(num, page_index)
+    if items is None and page.limit > 0:
+        items = yield from find(page)
+    if page.limit == 0:
+        # no items, or page_index out of range:
+        items = []
+    page.set_cursors(items)
+    return page, items
+
 def user2cookie(user, max_age):
     '''
     Generate cookie str by user.
@@ -54,62 +228,103 @@ def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
+def blog2html(blog):
+    '''
+    Render markdown content of blog to html, use persisted or cached html if any.
+    '''
+    html = blog.get('html_content')
+    if html:
+        return html
+    key = (blog.id, hashlib.sha1(blog.content.encode('utf-8')).hexdigest())
+    html = _html_cache.get(key)
+    if html is None:
+        html = markdown2.markdown(blog.content)
+        _html_cache.set(key, html, tags=(blog.id,))
+    return html
+
+def prerender_blog(blog):
+    '''
+    Render html of new or edited blog before it is saved, so views never pay markdown cost.
+    '''
+    _html_cache.invalidate(blog.id)
+    blog.html_content = ''
+    blog.html_content = blog2html(blog)
+
 @asyncio.coroutine
 def cookie2user(cookie_str):
     '''
-    Parse cookie and load user if cookie is valid.
+    Parse cookie and load user if cookie is valid, results are cached in _session_cache.
     '''
     if not cookie_str:
         return None
+    L = cookie_str.split('-')
+    if len(L) != 3:
+        return None
+    uid, expires, sha1 = L
     try:
-        L = cookie_str.split('-')
-        if len(L) != 3:
-            return None
-        uid, expires, sha1 = L
-        if int(expires) < time.time():
+        ttl = int(expires) - time.time()
+    except ValueError:
+        return None
+    if ttl < 0:
+        return None
+    user = _session_cache.get(cookie_str)
+    if user is None:
+        try:
+            user = yield from _load_cookie_user(uid, expires, sha1)
+        except Exception as e:
+            # do not cache failures of database:
+            logging.exception(e)
             return None
-        user = yield from User.find(uid)
         if user is None:
-            return None
-        s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
-        if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
-            logging.info('invalid sha1')
-            return None
-        user.passwd = '******'
-        return user
-    except Exception as e:
-        logging.exception(e)
+            _session_cache.set(cookie_str, False, ttl=min(ttl, configs.cache.session_negative_ttl), tags=(uid,))
+        else:
+            _session_cache.set(cookie_str, user, ttl=min(ttl, configs.cache.session_ttl), tags=(uid,))
+    return user or None
+
+@asyncio.coroutine
+def _load_cookie_user(uid, expires, sha1):
+    user = yield from User.find(uid)
+    if user is None:
         return None
+    s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
+    if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
+        logging.info('invalid sha1')
+        return None
+    # copy, the found user may be shared by the identity map of this request:
+    user = User(**user)
+    user.passwd = '******'
+    return user
 
 @get('/')
-def index(*, request, page='1'):
+@cache_page(30)
+@cache_control('public, max-age=30')
+def index(*, request, page='1', cursor=None):
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    #page = Page(num)
-    page = Page(num, page_index)
-    if num == 0:
-        blogs = []
+    admin=is_admin(request)
+    if admin:
+        page, blogs = yield from find_page(Blog, page_index, cursor=cursor, compact=True)
     else:
-        admin=is_admin(request)
-        if admin:
-            blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
-        else:
-            blogs = yield from Blog.findAll('private_blogs=?', [0], orderBy='created_at desc', limit=(page.offset, page.limit))
+        page, blogs = yield from find_page(Blog, page_index, 'private_blogs=?', [0], cursor=cursor, compact=True)
     return {
         '__template__': 'blogs.html',
         'page': page,
         'blogs': blogs
     }
 
-@get('/blog/{id}')
+@get('/blog/{id}', coalesce=True)
+@cache_page(60)
+@cache_control('public, max-age=60')
 def get_blog(id):
-    blog = yield from Blog.find(id)
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    blog, comments = yield from orm.gather(Blog.find(id), Comment.findAll('blog_id=?', [id], orderBy='created_at desc', defer=False))
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    blog.html_content = blog2html(blog)
     return {
         '__template__': 'blog.html',
+        # changes when blog is edited or comments are added or removed:
+        '__etag__': make_etag(blog.id, blog.name, blog.summary, blog.content, *[c.id for c in comments]),
+        # long comment threads render while being sent to signed in users:
+        '__stream__': 0 < configs.templates.stream_comments <= len(comments),
         'blog': blog,
         'comments': comments
     }
@@ -148,13 +363,16 @@ def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 @get('/signout')
 def signout(request):
     referer = request.headers.get('Referer')
     r = web.HTTPFound(referer or '/')
+    cookie_str = request.cookies.get(COOKIE_NAME)
+    if cookie_str:
+        _session_cache.delete(cookie_str)
     r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
     logging.info('user signed out.')
     return r
@@ -201,14 +419,9 @@ def manage_users(*, page='1'):
     }
 
 @get('/api/comments')
-def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    return dict(page=p, comments=comments)
+def api_comments(*, page='1', cursor=None):
+    p, comments = yield from find_page(Comment, get_page_index(page), cursor=cursor, defer=False, plain=True)
+    return dict(page=p, comments=comments or ())
 
 @post('/api/blogs/{id}/comments')
 def api_create_comment(id, request, *, content):
@@ -235,17 +448,20 @@ def api_delete_comments(id, request):
     return dict(id=id)
 
 @get('/api/users')
-def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
+def api_get_users(*, page='1', cursor=None):
+    p, users = yield from find_page(User, get_page_index(page), cursor=cursor, plain=True)
+    if not users:
         return dict(page=p, users=())
-    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
 
+@get('/api/stats')
+def api_get_stats(request):
+    ' database pool metrics and top statements of this process. '
+    check_admin(request)
+    return dict(pid=os.getpid(), pools=orm.pool_stats(), statements=orm.statement_stats(20))
+
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
@@ -266,25 +482,25 @@ def api_register_user(*, email, name, passwd):
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
     #user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://img.cyol.com/img/news/attachement/jpg/site2/20160811/IMG0071cc19945f42092995120.jpg')
     yield from user.save()
-    # make session cookie:
+    # make session cookie, its requests read the new user from primary database:
+    cookie = user2cookie(user, 86400)
+    orm.pin_session(cookie)
     r = web.Response()
-    r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
+    r.set_cookie(COOKIE_NAME, cookie, max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
-@get('/api/blogs')
-def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    return dict(page=p, blogs=blogs)
-
-@get('/api/blogs/{id}')
+@get('/api/blogs', coalesce=True)
+# data the admin edits, revalidated by ETag every time:
+@cache_control('private, no-cache')
+def api_blogs(*, page='1', cursor=None):
+    p, blogs = yield from find_page(Blog, get_page_index(page), cursor=cursor, plain=True)
+    return dict(page=p, blogs=blogs or ())
+
+@get('/api/blogs/{id}', coalesce=True)
+@cache_control('private, no-cache')
 def api_get_blog(*, id):
     blog = yield from Blog.find(id)
     return blog
@@ -299,7 +515,10 @@ def api_create_blog(request, *, name, private_blogs, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), private_blogs=private_blogs, summary=summary.strip(), content=content.strip())
+    blog.getValueOrDefault('id') # html cache is keyed by id
+    prerender_blog(blog)
     yield from blog.save()
+    index_blog(blog)
     return blog
 
 @post('/api/blogs/{id}')
@@ -315,7 +534,10 @@ def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
+    # content and html_content are written by the same update statement:
+    prerender_blog(blog)
     yield from blog.update()
+    index_blog(blog)
     return blog
 
 @post('/api/blogs/{id}/delete')
@@ -323,6 +545,8 @@ def api_delete_blog(request, *, id):
     check_admin(request)
     blog = yield from Blog.find(id)
     yield from blog.remove()
+    _html_cache.invalidate(id)
+    index_blog(blog, remove=True)
     return dict(id=id)
 
 @get('/welcome/{name}')
@@ -344,14 +568,19 @@ def showUsers(request):
         'users': users
     }
 
-@get('/search/{type}/{word}')
+@get('/search/{type}/{word}', coalesce=True)
+@cache_page(60)
 def search_word(*, type='name', word='1', page='1'):
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    #select count(id) _num_ from `blogs`    根据id计数，找到blog中所有信息个数
-    page = Page(num, page_index)                        #根据页码的信息去找到要传回去的信息个数，起始和终止
-    #blogs = yield from Blog.findAll('`name`', like='\'%%C%%\'', orderBy='created_at desc')
-    blogs = yield from Blog.findAll('`%s`' % type, like='%s' % word, orderBy='created_at desc', limit=(page.offset, page.limit))
+    fields = (type,) if type in SearchIndex.FIELDS else None
+    ids = _search_index.search(word, fields)
+    page = Page(len(ids), page_index)
+    ids = ids[page.offset:page.offset + page.limit]
+    blogs = []
+    if ids:
+        rank = dict((id, i) for i, id in enumerate(ids))
+        blogs = yield from Blog.findAll('id in (%s)' % orm.create_args_string(len(ids)), list(ids), compact=True)
+        blogs.sort(key=lambda b: rank[b.id])
     url = word + '?page='          #值得注意，只需要最后一个变量，多了会出错
     return {
         '__template__': 'search_blogs.html',
@@ -10,6 +10,7 @@ __author__ = 'Hellozmz'
 import time, uuid
 
 from orm import Model, StringField, BooleanField, FloatField, TextField
+from config import configs
 
 def next_id():
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
@@ -37,6 +38,9 @@ class Blog(Model):
     content = TextField()
     created_at = FloatField(default=time.time)
     private_blogs = BooleanField()
+    if configs.cache.html_persist:
+        # markdown of content rendered at write time, see schema_upgrade.sql:
+        html_content = TextField(default='')
 
 class Comment(Model):
     __table__ = 'comments'
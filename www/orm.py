@@ -3,18 +3,19 @@
 
 __author__ = 'Hellozmz'
 
-import asyncio, logging
+import os, asyncio, logging, json, base64, time, collections, re, contextvars
 
 import aiomysql
 
+from cache import LRUCache
+from pools import InstrumentedPool, Histogram
+
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    logging.debug('SQL: %s' % sql)
 
 @asyncio.coroutine
-def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
-    global __pool
-    __pool = yield from aiomysql.create_pool(
+def _connect(loop, kw, name):
+    pool = yield from aiomysql.create_pool(
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -26,21 +27,387 @@ def create_pool(loop, **kw):
         minsize=kw.get('minsize', 1),
         loop=loop
     )
+    pool = InstrumentedPool(pool, name, kw.get('minsize', 1), kw.get('maxsize', 100), kw.get('target_wait', 0))
+    yield from pool.warm_up()
+    return pool
+
+class Replica(object):
+    '''
+    Pool of a read replica, with the number of selects in flight on it.
+    '''
+
+    def __init__(self, pool, host):
+        self.pool = pool
+        self.host = host
+        self.outstanding = 0
+        self.requests = 0
+
+_replicas = []
+_replica_options = dict(read_your_writes=0)
+# session => time until which reads of the session go to primary:
+_pinned = dict()
+# time of last write to a table, replica reads of it do not fill query cache:
+_written_at = dict()
 
 @asyncio.coroutine
-def select(sql, args, size=None):
-    log(sql, args)
+def create_pool(loop, **kw):
+    '''
+    Create pool of primary database, and of replicas=[...] if given: a list
+    of dicts overriding host, port, user etc. of the primary. select() reads
+    from replicas, except reads of a session (see open_session) within
+    read_your_writes seconds after it wrote, which go to primary.
+    '''
+    logging.info('create database connection pool...')
     global __pool
-    with (yield from __pool) as conn:
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
-        if size:
-            rs = yield from cur.fetchmany(size)
-        else:
+    __pool = yield from _connect(loop, kw, 'primary')
+    _replicas[:] = []
+    for override in kw.get('replicas') or []:
+        conf = dict(kw)
+        conf.update(override)
+        logging.info('create replica connection pool: %s' % conf.get('host', 'localhost'))
+        _replicas.append(Replica((yield from _connect(loop, conf, 'replica %s' % conf.get('host', 'localhost'))), conf.get('host', 'localhost')))
+    _replica_options['read_your_writes'] = kw.get('read_your_writes', 0)
+
+@asyncio.coroutine
+def close_pool():
+    ' close all connections of pools, wait until they are closed. '
+    global __pool
+    pools = [__pool] + [r.pool for r in _replicas]
+    for pool in pools:
+        pool.close()
+    for pool in pools:
+        yield from pool.wait_closed()
+
+@asyncio.coroutine
+def acquire():
+    ' acquire a connection from pool, must be given back by release(). '
+    global __pool
+    return (yield from __pool.acquire())
+
+def release(conn):
+    global __pool
+    __pool.release(conn)
+
+_session = contextvars.ContextVar('orm_session', default=None)
+# reads of current task after it wrote, if it has no session:
+_task_pinned = contextvars.ContextVar('orm_task_pinned', default=0)
+
+def open_session(key):
+    ' set session key (e.g. the session cookie) of current task, return token for close_session(). '
+    return _session.set(key)
+
+def close_session(token):
+    _session.reset(token)
+
+def pin_session(key=None, publish=True):
+    '''
+    Route reads of session key (current session if None) to primary, past
+    the query and count caches, for read_your_writes seconds, called after
+    every write. Pins of sessions are published, see set_publisher().
+    '''
+    window = _replica_options['read_your_writes']
+    if not window or (not _replicas and _query_cache is None):
+        return
+    until = time.time() + window
+    if key is None:
+        key = _session.get()
+    if key is None:
+        _task_pinned.set(until)
+        return
+    if len(_pinned) >= 10000:
+        now = time.time()
+        for k in [k for k, t in _pinned.items() if t < now]:
+            del _pinned[k]
+    _pinned[key] = until
+    if publish and _publisher is not None:
+        _publisher('pin', key)
+
+def is_pinned():
+    ' True if current task or session wrote within read_your_writes seconds. '
+    if not _replica_options['read_your_writes']:
+        return False
+    now = time.time()
+    if _task_pinned.get() > now:
+        return True
+    key = _session.get()
+    return key is not None and _pinned.get(key, 0) > now
+
+def _read_replica():
+    '''
+    Replica with least selects in flight to read from, None to read primary.
+    '''
+    if not _replicas or is_pinned():
+        return None
+    return min(_replicas, key=lambda r: (r.outstanding, r.requests))
+
+def pool_stats():
+    ' metrics of primary and replica pools, see InstrumentedPool.stats(). '
+    global __pool
+    return dict(primary=__pool.stats(),
+        replicas=[dict(r.pool.stats(), outstanding=r.outstanding, requests=r.requests) for r in _replicas])
+
+class TemplateStats(object):
+    '''
+    Latency histogram (ms), errors and rows of one normalized sql template.
+    '''
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.rows = 0
+
+# normalized sql => TemplateStats of statements run:
+_statement_stats = dict()
+_profile_options = dict(slow=200, explain=False)
+_explained = set()
+
+def set_slow_query(threshold=200, explain=False):
+    '''
+    Log statements slower than threshold ms (0 to disable) with redacted
+    args, and the EXPLAIN of slow selects (once per template) if explain.
+    '''
+    _profile_options['slow'] = threshold
+    _profile_options['explain'] = explain
+    _explained.clear()
+
+def _redact(args):
+    return ['<%s>' % type(a).__name__ for a in (args or ())]
+
+def _record(sql, started, rows=0, error=False, args=None):
+    elapsed = (time.perf_counter() - started) * 1000
+    template = _statement(sql).template
+    st = _statement_stats.get(template)
+    if st is None:
+        if len(_statement_stats) >= 1000:
+            template = '(other)'
+            st = _statement_stats.get(template)
+        if st is None:
+            st = _statement_stats[template] = TemplateStats()
+    st.latency.observe(elapsed)
+    if error:
+        st.errors = st.errors + 1
+    st.rows = st.rows + rows
+    slow = _profile_options['slow']
+    if slow and elapsed >= slow:
+        logging.warning('slow query: %.1f ms, %s rows: %s args: %s' % (elapsed, rows, sql, _redact(args)))
+        if _profile_options['explain'] and not error and template not in _explained and _statement(sql).table is None and sql.lstrip()[:6].lower() == 'select':
+            _explained.add(template)
+            asyncio.ensure_future(_explain(sql, args))
+
+@asyncio.coroutine
+def _explain(sql, args):
+    global __pool
+    try:
+        with (yield from __pool) as conn:
+            cur = yield from conn.cursor(aiomysql.DictCursor)
+            yield from cur.execute('explain ' + _statement(sql).sql, args or ())
             rs = yield from cur.fetchall()
-        yield from cur.close()
-        logging.info('rows returned: %s' % len(rs))
-        return rs
+            yield from cur.close()
+        logging.warning('explain of slow query: %s\n%s' % (sql, '\n'.join(str(r) for r in rs)))
+    except Exception as e:
+        logging.warning('explain of slow query failed: %s: %s' % (sql, e))
+
+def statement_stats(n=None):
+    '''
+    Counts, errors, latency (ms) and rows of normalized sql templates run by
+    this process, by total time desc, top n if given.
+    '''
+    stats = []
+    for template, st in _statement_stats.items():
+        h = st.latency
+        stats.append(dict(sql=template, count=h.count, errors=st.errors, total=round(h.total, 3), mean=round(h.total / h.count, 3),
+            p95=h.percentile(95), max=round(h.max, 3), rows=st.rows))
+    stats.sort(key=lambda x: -x['total'])
+    return stats[:n] if n else stats
+
+def dump_statement_stats(n=20):
+    ' log top n sql templates by total time, e.g. on SIGUSR1. '
+    lines = ['%8s %6s %10s %8s %8s %8s %8s  %s' % ('count', 'errors', 'total ms', 'mean', 'p95', 'max', 'rows', 'sql')]
+    for st in statement_stats(n):
+        lines.append('%8d %6d %10.1f %8.2f %8.2f %8.1f %8d  %s' % (st['count'], st['errors'], st['total'], st['mean'], st['p95'], st['max'], st['rows'], st['sql']))
+    logging.warning('top %s statements of pid %s:\n%s' % (n, os.getpid(), '\n'.join(lines)))
+
+class QueryCache(object):
+    '''
+    Interface of select result cache, keyed by (sql, args, size, tuples) and
+    tagged by the tables read. A shared backend (e.g. Redis) implements the
+    same coroutines.
+    '''
+
+    @asyncio.coroutine
+    def get(self, key):
+        ' return cached rows, or None. '
+        raise NotImplementedError()
+
+    @asyncio.coroutine
+    def set(self, key, rows, tables):
+        raise NotImplementedError()
+
+    @asyncio.coroutine
+    def invalidate(self, table):
+        ' drop all cached results which read table. '
+        raise NotImplementedError()
+
+    def stats(self):
+        ' dict of counters, at least hits and misses. '
+        raise NotImplementedError()
+
+class MemoryQueryCache(QueryCache):
+    '''
+    In-process QueryCache backed by LRUCache.
+    '''
+
+    def __init__(self, maxsize=10000, ttl=30):
+        self._cache = LRUCache(maxsize, ttl)
+
+    @asyncio.coroutine
+    def get(self, key):
+        return self._cache.get(key)
+
+    @asyncio.coroutine
+    def set(self, key, rows, tables):
+        self._cache.set(key, rows, tags=tables)
+
+    @asyncio.coroutine
+    def invalidate(self, table):
+        self._cache.invalidate(table)
+
+    def stats(self):
+        return self._cache.stats()
+
+_query_cache = None
+_write_listeners = []
+_publisher = None
+# bumped on every write, a select started before a write must not fill cache:
+_table_versions = collections.defaultdict(int)
+
+_RE_READ_TABLES = re.compile(r'\b(?:from|join)\s+`?(\w+)`?', re.IGNORECASE)
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?', re.IGNORECASE)
+
+# sql in aiomysql paramstyle, tables read and table written (or None):
+Statement = collections.namedtuple('Statement', ['sql', 'tables', 'table', 'template'])
+
+_RE_LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|\b\d+(?:\.\d+)?\b")
+_RE_ARG_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+
+def _normalize(sql):
+    ' template of sql for stats: literals as ?, lists of ? (and rows of them) as (...). '
+    return _RE_ARG_LISTS.sub('(...)', _RE_LITERALS.sub('?', sql))
+
+_statements = dict()
+
+def _statement(sql):
+    ' parse sql once, statements are kept until 1000 different sql are cached. '
+    st = _statements.get(sql)
+    if st is None:
+        m = _RE_WRITE_TABLE.match(sql)
+        st = Statement(sql.replace('?', '%s'), tuple(set(_RE_READ_TABLES.findall(sql))), m.group(1) if m else None, _normalize(sql))
+        if len(_statements) >= 1000:
+            _statements.clear()
+        _statements[sql] = st
+    return st
+
+_shapes = dict()
+
+def _shape(key, build):
+    ' sql built by build() for a query shape of Model, built once per key. '
+    sql = _shapes.get(key)
+    if sql is None:
+        sql = build()
+        if len(_shapes) >= 1000:
+            _shapes.clear()
+        _shapes[key] = sql
+    return sql
+
+def on_write(fn):
+    ' call fn(table) after every successful write to a table, of this or another process. '
+    _write_listeners.append(fn)
+
+def set_publisher(fn):
+    '''
+    Call fn('write', table) after writes of this process, and fn('pin', key)
+    when a session is pinned, to pass them on to other processes having
+    their own caches and pins: they call invalidate(table) and
+    pin_session(key, publish=False).
+    '''
+    global _publisher
+    _publisher = fn
+
+def set_query_cache(cache):
+    ' use cache (a QueryCache) for select results, None to disable. '
+    global _query_cache
+    _query_cache = cache
+
+def get_query_cache():
+    return _query_cache
+
+@asyncio.coroutine
+def _written(sql):
+    ' invalidate cached results of the table written by sql. '
+    table = _statement(sql).table
+    if table is None:
+        return
+    yield from invalidate(table)
+    if _publisher is not None:
+        _publisher('write', table)
+
+@asyncio.coroutine
+def invalidate(table):
+    ' drop cached results of table, e.g. written by another process. '
+    _table_versions[table] = _table_versions[table] + 1
+    _written_at[table] = time.time()
+    clear_count_cache(table)
+    if _query_cache is not None:
+        yield from _query_cache.invalidate(table)
+    for fn in _write_listeners:
+        fn(table)
+
+@asyncio.coroutine
+def select(sql, args, size=None, tuples=False, cache=True):
+    ' select rows as dicts, or as tuples in column order if tuples is True. '
+    # a session which just wrote reads its writes from primary:
+    qc = _query_cache if cache and not is_pinned() else None
+    if qc is not None:
+        key = (sql, tuple(args or ()), size, tuples)
+        rs = yield from qc.get(key)
+        if rs is not None:
+            return list(rs)
+        tables = _statement(sql).tables
+        versions = [_table_versions[t] for t in tables]
+    log(sql, args)
+    global __pool
+    replica = _read_replica()
+    if replica is not None:
+        replica.outstanding = replica.outstanding + 1
+        replica.requests = replica.requests + 1
+    try:
+        with (yield from (__pool if replica is None else replica.pool)) as conn:
+            started = time.perf_counter()
+            try:
+                cur = yield from conn.cursor(aiomysql.Cursor if tuples else aiomysql.DictCursor)
+                yield from cur.execute(_statement(sql).sql, args or ())
+                if size:
+                    rs = yield from cur.fetchmany(size)
+                else:
+                    rs = yield from cur.fetchall()
+                yield from cur.close()
+            except BaseException:
+                _record(sql, started, error=True, args=args)
+                raise
+            _record(sql, started, len(rs), args=args)
+            logging.debug('rows returned: %s' % len(rs))
+    finally:
+        if replica is not None:
+            replica.outstanding = replica.outstanding - 1
+    if qc is not None and versions == [_table_versions[t] for t in tables]:
+        # a replica may not have caught up with recent writes yet:
+        if replica is None or not _recently_written(tables):
+            yield from qc.set(key, rs, tables)
+    return rs
+
+def _recently_written(tables):
+    since = time.time() - _replica_options['read_your_writes']
+    return any(_written_at.get(t, 0) > since for t in tables)
 
 @asyncio.coroutine
 def execute(sql, args, autocommit=True):
@@ -48,18 +415,284 @@ def execute(sql, args, autocommit=True):
     with (yield from __pool) as conn:
         if not autocommit:
             yield from conn.begin()
+        started = time.perf_counter()
         try:
             cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?', '%s'), args)
+            yield from cur.execute(_statement(sql).sql, args)
             affected = cur.rowcount
             yield from cur.close()
             if not autocommit:
                 yield from conn.commit()
         except BaseException as e:
+            _record(sql, started, error=True, args=args)
             if not autocommit:
                 yield from conn.rollback()
             raise
-        return affected
+        _record(sql, started, affected, args=args)
+    pin_session()
+    yield from _written(sql)
+    return affected
+
+@asyncio.coroutine
+def execute_many(statements):
+    ' execute (sql, args) statements in one transaction, return affected rows of each. '
+    results = []
+    with (yield from __pool) as conn:
+        yield from conn.begin()
+        try:
+            cur = yield from conn.cursor()
+            for sql, args in statements:
+                log(sql)
+                started = time.perf_counter()
+                try:
+                    yield from cur.execute(_statement(sql).sql, args)
+                except BaseException:
+                    _record(sql, started, error=True, args=args)
+                    raise
+                _record(sql, started, cur.rowcount, args=args)
+                results.append(cur.rowcount)
+            yield from cur.close()
+            yield from conn.commit()
+        except BaseException as e:
+            yield from conn.rollback()
+            raise
+    pin_session()
+    for sql, args in statements:
+        yield from _written(sql)
+    return results
+
+_count_cache = dict()
+_count_options = dict(ttl=10, approximate=False)
+
+def set_count_cache(ttl=10, approximate=False):
+    '''
+    Configure cache of findNumber: ttl in seconds (0 to disable), approximate
+    to read count(pk) of whole table from information_schema table stats.
+    '''
+    _count_options['ttl'] = ttl
+    _count_options['approximate'] = approximate
+    _count_cache.clear()
+
+def clear_count_cache(table=None):
+    ' drop cached numbers of table, or all tables if table is None. '
+    if table is None:
+        _count_cache.clear()
+        return
+    for key in [k for k in _count_cache if k[0] == table]:
+        del _count_cache[key]
+
+class RowIterator(object):
+    '''
+    Async iterator over rows of select, backed by aiomysql.SSDictCursor.
+
+    Use in 'async with' to release the connection when leaving the loop
+    early, an iterator dropped while open closes its connection.
+    '''
+
+    def __init__(self, sql, args, batch_size, factory):
+        if batch_size < 1:
+            raise ValueError('Invalid batch_size value: %s' % str(batch_size))
+        self._sql = sql
+        self._args = args
+        self._batch_size = batch_size
+        self._factory = factory
+        self._conn = None
+        self._cur = None
+        self._replica = None
+        self._rows = collections.deque()
+        self._count = 0
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, *args):
+        yield from self.close()
+
+    def __del__(self):
+        if self._conn is None:
+            return
+        # unread rows are still on the wire, so the connection can not be reused:
+        logging.warning('RowIterator not closed: %s' % self._sql)
+        conn, replica = self._conn, self._replica
+        self._conn = self._cur = self._replica = None
+        conn.close()
+        self._release(conn, replica)
+
+    @asyncio.coroutine
+    def __anext__(self):
+        while not self._rows:
+            if self._done:
+                raise StopAsyncIteration
+            yield from self._fetch()
+        return self._factory(self._rows.popleft())
+
+    @asyncio.coroutine
+    def batch(self):
+        ' return next list of up to batch_size objects, [] when exhausted. '
+        if not self._rows and not self._done:
+            yield from self._fetch()
+        rs = list(self._rows)
+        self._rows.clear()
+        return [self._factory(r) for r in rs]
+
+    @asyncio.coroutine
+    def _fetch(self):
+        try:
+            if self._cur is None:
+                log(self._sql, self._args)
+                self._replica = _read_replica()
+                if self._replica is None:
+                    self._conn = yield from acquire()
+                else:
+                    self._replica.outstanding = self._replica.outstanding + 1
+                    self._replica.requests = self._replica.requests + 1
+                    try:
+                        self._conn = yield from self._replica.pool.acquire()
+                    except BaseException:
+                        self._replica.outstanding = self._replica.outstanding - 1
+                        self._replica = None
+                        raise
+                self._cur = yield from self._conn.cursor(aiomysql.SSDictCursor)
+                yield from self._cur.execute(_statement(self._sql).sql, self._args or ())
+            rs = yield from self._cur.fetchmany(self._batch_size)
+        except BaseException:
+            yield from self.close()
+            raise
+        self._count = self._count + len(rs)
+        self._rows.extend(rs)
+        if len(rs) < self._batch_size:
+            yield from self.close()
+
+    @asyncio.coroutine
+    def close(self):
+        ' close cursor and release connection, safe to call more than once. '
+        self._done = True
+        if self._conn is None:
+            return
+        conn, cur, replica = self._conn, self._cur, self._replica
+        self._conn = self._cur = self._replica = None
+        try:
+            if cur is not None:
+                yield from cur.close()
+        finally:
+            self._release(conn, replica)
+        logging.debug('rows returned: %s' % self._count)
+
+    @staticmethod
+    def _release(conn, replica):
+        if replica is None:
+            release(conn)
+        else:
+            replica.outstanding = replica.outstanding - 1
+            replica.pool.release(conn)
+
+class Scope(object):
+    '''
+    Identity map and find() batcher of one request, see open_scope().
+
+    find(pk) calls of a model issued in the same event loop tick are loaded
+    by one 'where pk in (...)' query, and found objects are kept so finding
+    them again returns the same instance without a query.
+    '''
+
+    def __init__(self):
+        self._objects = dict()
+        self._pending = dict()
+
+    def get(self, cls, pk):
+        return self._objects.get((cls, pk))
+
+    def put(self, obj):
+        self._objects[(obj.__class__, obj.getValue(obj.__primary_key__))] = obj
+
+    def discard(self, cls, pk):
+        self._objects.pop((cls, pk), None)
+
+    @asyncio.coroutine
+    def find(self, cls, pk):
+        key = (cls, pk)
+        if key in self._objects:
+            return self._objects[key]
+        loop = asyncio.get_event_loop()
+        pending = self._pending.get(cls)
+        if pending is None:
+            pending = self._pending[cls] = dict()
+            loop.call_soon(self._dispatch, cls)
+        fut = pending.get(pk)
+        if fut is None:
+            fut = pending[pk] = loop.create_future()
+        return (yield from asyncio.shield(fut))
+
+    def _dispatch(self, cls):
+        pending = self._pending.pop(cls)
+        asyncio.ensure_future(self._load(cls, pending))
+
+    @asyncio.coroutine
+    def _load(self, cls, pending):
+        pks = list(pending.keys())
+        try:
+            sql = '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(len(pks)))
+            rs = yield from select(sql, pks)
+        except BaseException as e:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for r in rs:
+            obj = cls(**r)
+            self._objects[(cls, r[cls.__primary_key__])] = obj
+        for pk, fut in pending.items():
+            if not fut.done():
+                fut.set_result(self._objects.get((cls, pk)))
+
+_scope = contextvars.ContextVar('orm_scope', default=None)
+
+def open_scope():
+    ' start a Scope for current task (e.g. one request), return token for close_scope(). '
+    return _scope.set(Scope())
+
+def close_scope(token):
+    _scope.reset(token)
+
+def current_scope():
+    return _scope.get()
+
+@asyncio.coroutine
+def gather(*coros):
+    '''
+    Run independent queries concurrently, each on its own pooled connection,
+    and return their results in order. If one fails, the others are
+    cancelled and waited for before its exception is raised.
+    '''
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return (yield from asyncio.gather(*tasks))
+    except BaseException:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+        yield from asyncio.wait(tasks)
+        raise
+
+def encode_cursor(created_at, pk, reverse=False):
+    ' encode opaque pagination cursor by (created_at, pk) and seek direction. '
+    s = json.dumps([1 if reverse else 0, created_at, pk], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    ' decode cursor into (created_at, pk, reverse). '
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        reverse, created_at, pk = json.loads(s)
+        return float(created_at), pk, bool(reverse)
+    except Exception:
+        raise ValueError('Invalid cursor value: %s' % str(cursor))
 
 def create_args_string(num):
     L = []
@@ -69,6 +702,9 @@ def create_args_string(num):
 
 class Field(object):
 
+    # deferred fields are left out of list queries unless asked for:
+    deferred = False
+
     def __init__(self, name, column_type, primary_key, default):
         self.name = name
         self.column_type = column_type
@@ -100,8 +736,89 @@ class FloatField(Field):
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
+    def __init__(self, name=None, default=None, deferred=True):
         super().__init__(name, 'text', False, default)
+        self.deferred = deferred
+
+class Row(object):
+    '''
+    Compact row of a Model with attributes in __slots__ instead of a dict.
+
+    Row classes are generated by ModelMetaclass as Model.__row__ and loaded
+    by findAll(..., compact=True). Fields which were not selected are unset.
+    '''
+
+    __slots__ = ()
+
+    @classmethod
+    def fromTuples(cls, names, rs):
+        ' build rows from tuples whose values are in order of names. '
+        new = object.__new__
+        setters = [getattr(cls, n).__set__ for n in names]
+        L = []
+        for t in rs:
+            row = new(cls)
+            for setter, value in zip(setters, t):
+                setter(row, value)
+            L.append(row)
+        return L
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [k for k in self.__slots__ if hasattr(self, k)]
+
+    def asDict(self):
+        ' dict of the loaded fields, used for JSON. '
+        return dict((k, getattr(self, k)) for k in self.keys())
+
+    def getValue(self, key):
+        return getattr(self, key, None)
+
+    def getCursor(self, reverse=False):
+        return encode_cursor(self.getValue('created_at'), self.getValue(self.__primary_key__), reverse)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.asDict())
+
+class Record(dict):
+    '''
+    Plain dict row of a Model with attribute access, for JSON results.
+
+    Record classes are generated by ModelMetaclass as Model.__record__ and
+    loaded by findAll(..., plain=True). Being dicts they are encoded by JSON
+    encoders natively, where a Row needs a default() call per row.
+    '''
+
+    __slots__ = ()
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def getValue(self, key):
+        return self.get(key)
+
+    def getCursor(self, reverse=False):
+        return encode_cursor(self.get('created_at'), self.get(self.__primary_key__), reverse)
 
 class ModelMetaclass(type):
 
@@ -133,14 +850,22 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey # 主键属性名
         attrs['__fields__'] = fields # 除主键外的属性名
+        attrs['__deferred__'] = [f for f in fields if mappings[f].deferred] # 列表查询默认不加载的属性名
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        attrs['__insert_many__'] = 'insert into `%s` (%s, `%s`) values ' % (tableName, ', '.join(escaped_fields), primaryKey)
+        attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + 1)
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        attrs['__row__'] = type('%sRow' % name, (Row,), dict(__slots__=tuple([primaryKey] + fields), __primary_key__=primaryKey)) # 紧凑行类型
+        attrs['__record__'] = type('%sRecord' % name, (Record,), dict(__slots__=(), __primary_key__=primaryKey))
         return type.__new__(cls, name, bases, attrs)
 
 class Model(dict, metaclass=ModelMetaclass):
 
+    # fields not loaded by a projected query, see loadDeferred():
+    _deferred = frozenset()
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
@@ -148,6 +873,8 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self._deferred:
+                raise AttributeError(r"'%s' field '%s' is deferred, load it by load() or loadDeferred() first" % (self.__class__.__name__, key))
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
@@ -156,6 +883,10 @@ class Model(dict, metaclass=ModelMetaclass):
     def getValue(self, key):
         return getattr(self, key, None)
 
+    def getCursor(self, reverse=False):
+        ' cursor to seek rows after this one, or before it if reverse. '
+        return encode_cursor(self.getValue('created_at'), self.getValue(self.__primary_key__), reverse)
+
     def getValueOrDefault(self, key):
         value = getattr(self, key, None)
         if value is None:
@@ -167,73 +898,258 @@ class Model(dict, metaclass=ModelMetaclass):
         return value
 
     @classmethod
-    @asyncio.coroutine
-    def findAll(cls, where=None, args=None, **kw):
-        ' find objects by where clause. '
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
+    def _columns(cls, fields=None, defer=False):
+        ' select clause and deferred field names of a query loading fields (all if None). '
+        if fields is None:
+            fields = [f for f in cls.__fields__ if f not in cls.__deferred__] if defer else cls.__fields__
+        else:
+            for f in fields:
+                if f not in cls.__mappings__:
+                    raise ValueError('Invalid field of %s: %s' % (cls.__name__, f))
+            fields = [f for f in cls.__fields__ if f in fields]
+        deferred = frozenset(f for f in cls.__fields__ if f not in fields)
+        if not deferred:
+            return cls.__select__, deferred
+        return 'select `%s`, %s from `%s`' % (cls.__primary_key__, ', '.join(map(lambda f: '`%s`' % f, fields)), cls.__table__), deferred
+
+    @classmethod
+    def _columnNames(cls, deferred):
+        ' selected field names in select clause order. '
+        return [cls.__primary_key__] + [f for f in cls.__fields__ if f not in deferred]
+
+    @classmethod
+    def _fromRow(cls, r, deferred):
+        obj = cls(**r)
+        if deferred:
+            object.__setattr__(obj, '_deferred', deferred)
+        return obj
+
+    @classmethod
+    def _selectSql(cls, where, args, kw):
+        ' build select sql, args and deferred fields of findAll / iterAll, and whether rows come back reversed. '
+        fields = kw.get('fields', None)
+        defer = kw.get('defer', True)
         like = kw.get('like', None)         #like
-        if like:
-            sql.append('like')
-            ch = '"%%'+like+'%%"'
-            sql.append(ch)
-        orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
+        cursor = kw.get('cursor', None)
+        orderBy = None if cursor else kw.get('orderBy', None)
         limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = yield from select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        args = [] if args is None else list(args)
+        reverse = False
+        if cursor:
+            if 'created_at' not in cls.__mappings__:
+                raise ValueError('Cursor pagination requires created_at field in %s' % cls.__name__)
+            created_at, pk, reverse = decode_cursor(cursor)
+            args.extend([created_at, created_at, pk])
+            if not isinstance(limit, int):
+                raise ValueError('Invalid limit value for cursor: %s' % str(limit))
+        if limit is None:
+            nlimit = 0
+        elif isinstance(limit, int):
+            nlimit = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            nlimit = 2
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        def build():
+            select_sql, deferred = cls._columns(fields, defer)
+            sql = [select_sql]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            if like:
+                sql.append('like')
+                ch = '"%%'+like+'%%"'
+                sql.append(ch)
+            if cursor:
+                op = '>' if reverse else '<'
+                sql.append('and' if (where or like) else 'where')
+                sql.append('(`created_at` %s ? or (`created_at` = ? and `%s` %s ?))' % (op, cls.__primary_key__, op))
+                sql.append('order by')
+                sql.append('`created_at` %s, `%s` %s' % (('asc', cls.__primary_key__, 'asc') if reverse else ('desc', cls.__primary_key__, 'desc')))
+            elif orderBy:
+                sql.append('order by')
+                sql.append(orderBy)
+            if nlimit:
+                sql.append('limit')
+                sql.append('?' if nlimit == 1 else '?, ?')
+            return ' '.join(sql), deferred
+        key = ('select', cls, None if fields is None else frozenset(fields), defer, where, like, bool(cursor), reverse, orderBy, nlimit)
+        sql, deferred = _shape(key, build)
+        return sql, args, deferred, reverse
 
     @classmethod
     @asyncio.coroutine
-    def findNumber(cls, selectField, where=None, args=None):
-        ' find number by select and where. '
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1)
+    def findAll(cls, where=None, args=None, **kw):
+        ''' find objects by where clause.
+
+        Only fields=[...] are loaded if given (primary key always is), else
+        deferred fields (TextField) are left out unless defer=False.
+
+        With compact=True, rows are built as cls.__row__ objects straight
+        from tuples, which is cheaper than dict based Model objects but can
+        not take new attributes, nor be saved. With plain=True, rows are
+        cls.__record__ dicts built straight from tuples, the cheapest to load
+        and to encode as JSON.
+
+        Pass cursor=... (see getCursor) to seek by (created_at, pk) instead of
+        skipping rows by offset, then limit must be an int and orderBy is
+        ignored: rows always come back as 'created_at desc, pk desc'.
+        '''
+        sql, args, deferred, reverse = cls._selectSql(where, args, kw)
+        compact = kw.get('compact', False)
+        plain = kw.get('plain', False)
+        rs = yield from select(sql, args, tuples=compact or plain)
+        if reverse:
+            rs = list(reversed(rs))
+        if compact:
+            return cls.__row__.fromTuples(cls._columnNames(deferred), rs)
+        if plain:
+            names = cls._columnNames(deferred)
+            new = cls.__record__
+            return [new(zip(names, t)) for t in rs]
+        return [cls._fromRow(r, deferred) for r in rs]
+
+    @classmethod
+    def iterAll(cls, where=None, args=None, batch_size=1000, **kw):
+        ''' iterate objects by where clause without loading all rows in memory.
+
+        Use as 'async with Model.iterAll(...) as it: async for obj in it',
+        rows are read from an unbuffered server side cursor batch_size rows
+        at a time, and the connection is released on leaving the with block.
+        Cursor seek is not supported.
+        '''
+        if kw.get('cursor'):
+            raise ValueError('Cursor is not supported by iterAll.')
+        sql, args, deferred, reverse = cls._selectSql(where, args, kw)
+        return RowIterator(sql, args, batch_size, lambda r: cls._fromRow(r, deferred))
+
+    @classmethod
+    @asyncio.coroutine
+    def findNumber(cls, selectField, where=None, args=None, cache=True):
+        ' find number by select and where, cached for count_cache ttl seconds. '
+        ttl = _count_options['ttl'] if cache and not is_pinned() else 0
+        if ttl:
+            key = (cls.__table__, selectField, where, tuple(args or ()))
+            hit = _count_cache.get(key)
+            if hit and hit[0] > time.time():
+                return hit[1]
+        if not where and _count_options['approximate'] and selectField.replace(' ', '').lower() in ('count(*)', 'count(%s)' % cls.__primary_key__.lower()):
+            sql = 'select table_rows _num_ from information_schema.tables where table_schema=database() and table_name=?'
+            rs = yield from select(sql, [cls.__table__], 1)
+        else:
+            def build():
+                sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+                if where:
+                    sql.append('where')
+                    sql.append(where)
+                return ' '.join(sql)
+            rs = yield from select(_shape(('number', cls, selectField, where), build), args, 1)
         if len(rs) == 0:
             return None
-        return rs[0]['_num_']
+        num = rs[0]['_num_']
+        if ttl:
+            if len(_count_cache) >= 1000:
+                _count_cache.clear()
+            _count_cache[key] = (time.time() + ttl, num)
+        return num
 
     @classmethod
     @asyncio.coroutine
-    def find(cls, pk):
-        ' find object by primary key. '
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+    def find(cls, pk, fields=None):
+        ' find object by primary key, load only fields=[...] if given. '
+        scope = _scope.get()
+        if scope is not None and fields is None:
+            return (yield from scope.find(cls, pk))
+        def build():
+            select_sql, deferred = cls._columns(fields)
+            return '%s where `%s`=?' % (select_sql, cls.__primary_key__), deferred
+        sql, deferred = _shape(('find', cls, None if fields is None else frozenset(fields)), build)
+        rs = yield from select(sql, [pk], 1)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls._fromRow(rs[0], deferred)
+
+    @classmethod
+    @asyncio.coroutine
+    def loadDeferred(cls, objs, fields=None):
+        ' load deferred fields (or given fields) of objects by one query. '
+        if fields is None:
+            fields = set()
+            for obj in objs:
+                fields.update(obj._deferred)
+        fields = [f for f in cls.__fields__ if f in fields]
+        pks = [obj.getValue(cls.__primary_key__) for obj in objs]
+        if not fields or not pks:
+            return
+        sql = 'select `%s`, %s from `%s` where `%s` in (%s)' % (cls.__primary_key__, ', '.join(map(lambda f: '`%s`' % f, fields)), cls.__table__, cls.__primary_key__, create_args_string(len(pks)))
+        rs = yield from select(sql, pks)
+        rows = dict((r[cls.__primary_key__], r) for r in rs)
+        for obj in objs:
+            r = rows.get(obj.getValue(cls.__primary_key__))
+            if r is None:
+                continue
+            for f in fields:
+                obj[f] = r[f]
+            object.__setattr__(obj, '_deferred', obj._deferred.difference(fields))
+
+    @asyncio.coroutine
+    def load(self, *fields):
+        ' load deferred fields (or given fields) of this object. '
+        yield from self.loadDeferred([self], fields or None)
+
+    @classmethod
+    @asyncio.coroutine
+    def saveMany(cls, objs, chunk_size=500):
+        ' save objects by multi-row insert in one transaction, return affected rows of each chunk. '
+        if chunk_size < 1:
+            raise ValueError('Invalid chunk_size value: %s' % str(chunk_size))
+        statements = []
+        for i in range(0, len(objs), chunk_size):
+            chunk = objs[i:i + chunk_size]
+            args = []
+            for obj in chunk:
+                args.extend(map(obj.getValueOrDefault, cls.__fields__))
+                args.append(obj.getValueOrDefault(cls.__primary_key__))
+            sql = cls.__insert_many__ + ', '.join([cls.__insert_row__] * len(chunk))
+            statements.append((sql, args))
+        if not statements:
+            return []
+        rows = yield from execute_many(statements)
+        for n, (chunk_rows, (sql, args)) in enumerate(zip(rows, statements)):
+            expected = len(args) // (len(cls.__fields__) + 1)
+            if chunk_rows != expected:
+                logging.warn('failed to insert chunk %s: affected rows: %s, expected: %s' % (n, chunk_rows, expected))
+        return rows
+
+    def _remember(self):
+        ' keep fully loaded object in identity map of current scope. '
+        scope = _scope.get()
+        if scope is not None and not self._deferred:
+            scope.put(self)
 
     @asyncio.coroutine
     def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         rows = yield from execute(self.__insert__, args)
+        self._remember()
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
 
     @asyncio.coroutine
     def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        fields = self.__fields__
+        sql = self.__update__
+        if self._deferred:
+            # never overwrite columns which were not loaded:
+            fields = [f for f in fields if f not in self._deferred]
+            sql = 'update `%s` set %s where `%s`=?' % (self.__table__, ', '.join(map(lambda f: '`%s`=?' % (self.__mappings__.get(f).name or f), fields)), self.__primary_key__)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+        rows = yield from execute(sql, args)
+        self._remember()
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
 
@@ -241,5 +1157,8 @@ class Model(dict, metaclass=ModelMetaclass):
     def remove(self):
         args = [self.getValue(self.__primary_key__)]
         rows = yield from execute(self.__delete__, args)
+        scope = _scope.get()
+        if scope is not None:
+            scope.discard(self.__class__, args[0])
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
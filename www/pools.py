@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+Instrumented database connection pool.
+
+Wraps an aiomysql pool to measure checkout waits, connections in use and
+opened / closed, and to bound connections in use by a limit which can
+adapt to a target checkout wait.
+'''
+
+import time, asyncio, weakref, bisect, logging, collections
+
+class Histogram(object):
+    '''
+    Counts of values in buckets of upper bounds (in ms).
+
+    >>> h = Histogram((1, 10))
+    >>> for v in (0.5, 2, 3, 50): h.observe(v)
+    >>> h.counts
+    [1, 2, 1]
+    >>> h.percentile(50)
+    10
+    '''
+
+    BOUNDS = (0.1, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+    def __init__(self, bounds=None):
+        self.bounds = tuple(bounds or self.BOUNDS)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count = self.count + 1
+        self.total = self.total + value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        ' upper bound of the bucket holding the p-th percentile, at most max. '
+        if self.count == 0:
+            return 0
+        rank = self.count * p / 100.0
+        n = 0
+        for i, c in enumerate(self.counts):
+            n = n + c
+            if n >= rank and c:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def stats(self):
+        buckets = collections.OrderedDict()
+        for i, c in enumerate(self.counts):
+            buckets['%g' % self.bounds[i] if i < len(self.bounds) else 'inf'] = c
+        return dict(count=self.count, mean=round(self.total / self.count, 3) if self.count else 0, max=round(self.max, 3),
+            p50=self.percentile(50), p95=self.percentile(95), p99=self.percentile(99), buckets=buckets)
+
+class InstrumentedPool(object):
+    '''
+    aiomysql pool with metrics, used like the pool it wraps: acquire(),
+    release(conn) and 'with (yield from pool) as conn'.
+
+    At most limit connections are checked out, limit is maxsize unless
+    target_wait (ms) is set: then limit starts at 2 * minsize, and adjust()
+    grows it when the p95 checkout wait of recent checkouts is over target,
+    and shrinks it when waits are short and fewer than half of limit
+    connections were in use.
+    '''
+
+    def __init__(self, pool, name, minsize=1, maxsize=100, target_wait=0, adjust_interval=10):
+        self._pool = pool
+        self.name = name
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.limit = max(minsize, min(maxsize, minsize * 2)) if target_wait else maxsize
+        self.target_wait = target_wait
+        self.adjust_interval = adjust_interval
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquires = 0
+        self.opened = 0
+        self.closed = 0
+        self.resizes = 0
+        self.wait = Histogram()
+        self._recent = collections.deque(maxlen=200)
+        self._waiters = collections.deque()
+        self._seen = weakref.WeakSet()
+        self._adjusted = time.time()
+
+    def _on_close(self):
+        self.closed = self.closed + 1
+
+    @asyncio.coroutine
+    def acquire(self):
+        start = time.perf_counter()
+        if self.in_use >= self.limit or self._waiters:
+            fut = asyncio.Future()
+            self._waiters.append(fut)
+            try:
+                # _wake() takes the slot for us:
+                yield from fut
+            except BaseException:
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+                elif fut.done() and not fut.cancelled():
+                    # woken up but cancelled before running, pass the slot on:
+                    self.in_use = self.in_use - 1
+                    self._wake()
+                raise
+        else:
+            self.in_use = self.in_use + 1
+        try:
+            conn = yield from self._pool.acquire()
+        except BaseException:
+            self.in_use = self.in_use - 1
+            self._wake()
+            raise
+        waited = (time.perf_counter() - start) * 1000
+        self.wait.observe(waited)
+        self._recent.append(waited)
+        self.acquires = self.acquires + 1
+        if self.in_use > self.peak_in_use:
+            self.peak_in_use = self.in_use
+        if conn not in self._seen:
+            self._seen.add(conn)
+            self.opened = self.opened + 1
+            weakref.finalize(conn, self._on_close)
+        if self.target_wait and time.time() - self._adjusted > self.adjust_interval:
+            self.adjust()
+        return conn
+
+    def _wake(self):
+        while self._waiters and self.in_use < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_use = self.in_use + 1
+                fut.set_result(None)
+
+    def release(self, conn):
+        self.in_use = self.in_use - 1
+        self._pool.release(conn)
+        self._wake()
+
+    def __iter__(self):
+        conn = yield from self.acquire()
+        return _ContextManager(self, conn)
+
+    def adjust(self):
+        ' resize limit by recent checkout waits, see class doc. '
+        self._adjusted = time.time()
+        waits = sorted(self._recent)
+        self._recent.clear()
+        peak, self.peak_in_use = self.peak_in_use, self.in_use
+        if not waits:
+            return
+        p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+        limit = self.limit
+        if p95 > self.target_wait:
+            limit = min(self.maxsize, limit + max(1, limit // 4))
+        elif p95 < self.target_wait / 10.0 and peak < limit // 2:
+            limit = max(self.minsize, limit - 1)
+        if limit != self.limit:
+            logging.info('resize pool %s: limit %s => %s, p95 wait %.2f ms' % (self.name, self.limit, limit, p95))
+            self.limit = limit
+            self.resizes = self.resizes + 1
+            self._wake()
+
+    @asyncio.coroutine
+    def warm_up(self, size=None):
+        ' open and check size (default minsize) connections, so first requests do not wait for connects. '
+        size = min(size or self.minsize, self.limit)
+        conns = []
+        try:
+            for i in range(size):
+                conn = yield from self.acquire()
+                conns.append(conn)
+                cur = yield from conn.cursor()
+                yield from cur.execute('select 1')
+                yield from cur.fetchall()
+                yield from cur.close()
+        finally:
+            for conn in conns:
+                self.release(conn)
+        logging.info('pool %s warmed up: %s connections' % (self.name, len(conns)))
+
+    def close(self):
+        self._pool.close()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        yield from self._pool.wait_closed()
+
+    def stats(self):
+        return dict(name=self.name, minsize=self.minsize, maxsize=self.maxsize, limit=self.limit, target_wait=self.target_wait,
+            size=self._pool.size, idle=self._pool.freesize, in_use=self.in_use, waiting=len(self._waiters), acquires=self.acquires,
+            opened=self.opened, closed=self.closed, resizes=self.resizes, wait_ms=self.wait.stats())
+
+class _ContextManager(object):
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, *args):
+        self._pool.release(self._conn)
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,6 @@
+-- schema_upgrade.sql
+
+use awesome;
+
+-- cache.html_persist: store rendered markdown of blogs.
+alter table blogs add column `html_content` mediumtext not null after `content`;
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+In-process inverted index for full text search, ranked by BM25.
+'''
+
+import os, sys, re, json, math, mmap, fcntl, struct, array, logging, itertools, collections
+
+_RE_TOKEN = re.compile(r'[0-9a-z\u00c0-\u024f]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+')
+
+def tokenize(text, query=False):
+    '''
+    Split text into lower case words, CJK text (which has no spaces) into
+    single chars and overlapping bigrams. Queries use bigrams only, so a
+    CJK query matches as a phrase rather than as any of its chars.
+
+    >>> tokenize('Hello, 数据库!')
+    ['hello', '数', '数据', '据', '据库', '库']
+    >>> tokenize('Hello, 数据库!', query=True)
+    ['hello', '数据', '据库']
+    >>> tokenize('库', query=True)
+    ['库']
+    '''
+    tokens = []
+    for run in _RE_TOKEN.findall(text.lower()):
+        if run[0] < '\u3040':
+            tokens.append(run)
+            continue
+        if len(run) == 1:
+            tokens.append(run)
+            continue
+        for i in range(len(run)):
+            if not query:
+                tokens.append(run[i])
+            if i + 1 < len(run):
+                tokens.append(run[i:i + 2])
+    return tokens
+
+_MAGIC = b'AWSIDX1\n'
+
+class SearchIndex(object):
+    '''
+    Inverted index of documents with text fields.
+
+    Postings of a field and term are flat arrays of (docno, tf) pairs.
+    Removed documents are only marked and skipped, save() compacts them.
+    An index loaded from disk keeps postings in a mmap and decodes a term
+    on first use.
+
+    >>> idx = SearchIndex()
+    >>> idx.add('a', dict(name='Python 教程', summary='', content='asyncio'))
+    >>> idx.add('b', dict(name='数据库', summary='Python', content='MySQL 数据库教程'))
+    >>> idx.search('python')
+    ['a', 'b']
+    >>> idx.search('教程', fields=('content',))
+    ['b']
+    >>> idx.remove('b')
+    >>> idx.search('数据库')
+    []
+    '''
+
+    FIELDS = ('name', 'summary', 'content')
+    WEIGHTS = dict(name=3.0, summary=2.0, content=1.0)
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self._ids = []
+        self._live = dict()
+        self._lengths = dict((f, array.array('I')) for f in self.FIELDS)
+        self._totals = dict((f, 0) for f in self.FIELDS)
+        self._postings = dict((f, dict()) for f in self.FIELDS)
+        self._stored = dict((f, dict()) for f in self.FIELDS)
+        self._mmap = None
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, id):
+        return id in self._live
+
+    def _decode(self, offset, count):
+        p = array.array('I')
+        p.frombytes(self._mmap[offset:offset + count * 8])
+        if sys.byteorder == 'big':
+            p.byteswap()
+        return p
+
+    def _get(self, field, term, create=False):
+        p = self._postings[field].get(term)
+        if p is not None:
+            return p
+        stored = self._stored[field].pop(term, None)
+        if stored is not None:
+            p = self._decode(*stored)
+        elif create:
+            p = array.array('I')
+        else:
+            return None
+        self._postings[field][term] = p
+        return p
+
+    def add(self, id, doc):
+        ' add or replace document id, doc is a dict of field => text. '
+        self.remove(id)
+        docno = len(self._ids)
+        self._ids.append(id)
+        self._live[id] = docno
+        for f in self.FIELDS:
+            tokens = tokenize(doc.get(f) or '')
+            self._lengths[f].append(len(tokens))
+            self._totals[f] = self._totals[f] + len(tokens)
+            for term, tf in collections.Counter(tokens).items():
+                self._get(f, term, True).extend((docno, tf))
+        self.dirty = True
+
+    def remove(self, id):
+        docno = self._live.pop(id, None)
+        if docno is None:
+            return
+        self._ids[docno] = None
+        for f in self.FIELDS:
+            self._totals[f] = self._totals[f] - self._lengths[f][docno]
+            self._lengths[f][docno] = 0
+        self.dirty = True
+
+    def search(self, query, fields=None):
+        '''
+        Return ids of documents matching all terms of query, best first.
+        '''
+        terms = list(collections.OrderedDict.fromkeys(tokenize(query, True)))
+        n = len(self._live)
+        if not terms or n == 0:
+            return []
+        scores = None
+        for term in terms:
+            term_scores = collections.defaultdict(float)
+            for f in (fields or self.FIELDS):
+                p = self._get(f, term)
+                if not p:
+                    continue
+                it = iter(p)
+                entries = [(docno, tf) for docno, tf in zip(it, it) if self._ids[docno] is not None]
+                if not entries:
+                    continue
+                df = len(entries)
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                avgdl = self._totals[f] / n or 1
+                lengths = self._lengths[f]
+                w = self.WEIGHTS[f] * idf
+                for docno, tf in entries:
+                    norm = self.K1 * (1 - self.B + self.B * lengths[docno] / avgdl)
+                    term_scores[docno] += w * tf * (self.K1 + 1) / (tf + norm)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = dict((d, s + term_scores[d]) for d, s in scores.items() if d in term_scores)
+            if not scores:
+                return []
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], -x[0]))
+        return [self._ids[d] for d, s in ranked]
+
+    def snapshot(self):
+        '''
+        Copy of index to save() in another thread while this one changes.
+        Postings still in the mmap are shared, not decoded.
+        '''
+        idx = self.__class__()
+        idx._ids = list(self._ids)
+        idx._live = dict(self._live)
+        idx._lengths = dict((f, a[:]) for f, a in self._lengths.items())
+        idx._totals = dict(self._totals)
+        idx._postings = dict((f, dict((term, p[:]) for term, p in d.items())) for f, d in self._postings.items())
+        idx._stored = dict((f, dict(d)) for f, d in self._stored.items())
+        idx._mmap = self._mmap
+        idx.dirty = self.dirty
+        return idx
+
+    def save(self, path):
+        '''
+        Write compacted index to path, atomically replacing the old file.
+        Postings in the mmap are decoded one at a time and not kept.
+        '''
+        renumber = dict()
+        ids = []
+        for docno, id in enumerate(self._ids):
+            if id is not None:
+                renumber[docno] = len(ids)
+                ids.append(id)
+        header = dict(ids=ids, fields=dict())
+        blobs = []
+        offset = 0
+        for f in self.FIELDS:
+            terms = dict()
+            stored = ((term, self._decode(*self._stored[f][term])) for term in self._stored[f])
+            for term, p in itertools.chain(self._postings[f].items(), stored):
+                it = iter(p)
+                out = array.array('I')
+                for docno, tf in zip(it, it):
+                    if docno in renumber:
+                        out.extend((renumber[docno], tf))
+                if not out:
+                    continue
+                if sys.byteorder == 'big':
+                    out.byteswap()
+                terms[term] = [offset, len(out) // 2]
+                blobs.append(out.tobytes())
+                offset = offset + len(blobs[-1])
+            lengths = self._lengths[f]
+            header['fields'][f] = dict(lengths=[lengths[d] for d in sorted(renumber)], terms=terms)
+        data = json.dumps(header, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(_MAGIC)
+            fp.write(struct.pack('<Q', len(data)))
+            fp.write(data)
+            for blob in blobs:
+                fp.write(blob)
+        os.replace(tmp, path)
+        self.dirty = False
+        logging.info('search index saved: %s documents to %s' % (len(ids), path))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load index saved by save(), postings stay in a mmap until used.
+        '''
+        with open(path, 'rb') as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('Invalid search index file: %s' % path)
+        start = len(_MAGIC) + 8
+        size = struct.unpack('<Q', mm[len(_MAGIC):start])[0]
+        header = json.loads(mm[start:start + size].decode('utf-8'))
+        base = start + size
+        idx = cls()
+        idx._mmap = mm
+        idx._ids = header['ids']
+        idx._live = dict((id, docno) for docno, id in enumerate(idx._ids))
+        for f in cls.FIELDS:
+            h = header['fields'][f]
+            idx._lengths[f] = array.array('I', h['lengths'])
+            idx._totals[f] = sum(h['lengths'])
+            idx._stored[f] = dict((term, (base + offset, count)) for term, (offset, count) in h['terms'].items())
+        logging.info('search index loaded: %s documents from %s' % (len(idx), path))
+        return idx
+
+def lock_index(path):
+    '''
+    Open path + '.lock' and wait for an exclusive lock of it, closing the
+    returned file releases the lock.
+    '''
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    except BaseException:
+        lock.close()
+        raise
+    return lock
+
+def save_merged(idx, changes, path, mtime=None):
+    '''
+    Save idx to path under an exclusive lock of path + '.lock'. If another
+    process saved path since mtime (of the file idx was loaded from or last
+    saved to), changes (id => doc, or None if removed) made to idx are
+    applied to the index in path instead, and that one is saved, so no
+    process overwrites updates of another. Return (index saved, new mtime).
+    '''
+    with lock_index(path):
+        if os.path.exists(path) and os.path.getmtime(path) != mtime:
+            idx = SearchIndex.load(path)
+            for id, doc in changes.items():
+                if doc is None:
+                    idx.remove(id)
+                else:
+                    idx.add(id, doc)
+        idx.save(path)
+        return idx, os.path.getmtime(path)
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+JSON serialization of handler results.
+
+Uses orjson if installed, else the C accelerated encoder of json module.
+Model and Record objects are dicts and encoded natively, Row and Page by
+default(), so JSON handlers load rows with plain=True rather than compact=True.
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from apis import Page
+from orm import Row
+
+# results having a list at least this long are encoded by iterdumps():
+STREAM_THRESHOLD = 500
+
+def default(o):
+    if isinstance(o, Row):
+        return o.asDict()
+    # Page and other plain objects:
+    return o.__dict__
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+
+def dumps(obj):
+    '''
+    Encode obj to JSON bytes.
+
+    >>> dumps(dict(page=Page(1), items=[1, 'a']))
+    b'{"page":{"item_count":1,"page_size":10,"page_count":1,"page_index":1,"offset":0,"limit":10,"has_next":false,"has_previous":false,"next_cursor":null,"previous_cursor":null},"items":[1,"a"]}'
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return _encoder.encode(obj).encode('utf-8')
+
+def is_large(obj):
+    ' True if obj is a dict with a list value of STREAM_THRESHOLD items or more. '
+    if not isinstance(obj, dict):
+        return False
+    for v in obj.values():
+        if isinstance(v, (list, tuple)) and len(v) >= STREAM_THRESHOLD:
+            return True
+    return False
+
+def iterdumps(obj, batch=100):
+    '''
+    Encode dict obj to JSON bytes chunks, list values are encoded batch items
+    per chunk, so the whole document is never built in memory.
+
+    >>> b''.join(iterdumps(dict(a=1, b=list(range(5))), batch=2))
+    b'{"a":1,"b":[0,1,2,3,4]}'
+    '''
+    if not isinstance(obj, dict):
+        yield dumps(obj)
+        return
+    first = True
+    for k, v in obj.items():
+        prefix = ('{' if first else ',') + _encoder.encode(str(k)) + ':'
+        first = False
+        if not isinstance(v, (list, tuple)) or len(v) <= batch:
+            yield prefix.encode('utf-8') + dumps(v)
+            continue
+        yield (prefix + '[').encode('utf-8')
+        for i in range(0, len(v), batch):
+            chunk = dumps(list(v[i:i + batch]))[1:-1]
+            yield chunk if i == 0 else b',' + chunk
+        yield b']'
+    yield b'{}' if first else b'}'
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hellozmz'
+
+'''
+Pre-fork multi-process server.
+
+The master forks worker processes which serve on a shared listen socket,
+either inherited from the master or bound by each worker with SO_REUSEPORT.
+Workers write heartbeats (empty lines) to a pipe, the master respawns
+workers which exit and kills workers whose heartbeats stop. SIGHUP restarts
+workers one by one, SIGTERM / SIGINT stops all of them gracefully, SIGUSR1
+is passed on to workers.
+
+Other lines a worker writes by publish() are passed on by the master to
+the other workers by a second pipe, where they call the function given to
+subscribe(), e.g. to invalidate caches after a write.
+'''
+
+import os, time, json, signal, socket, select, logging
+
+# a worker whose unread messages exceed this many bytes is killed:
+MAX_PENDING = 1 << 20
+
+class Worker(object):
+
+    def __init__(self, pid, index, fd, control):
+        self.pid = pid
+        self.index = index
+        self.fd = fd
+        self.control = control
+        self.received = b''
+        self.pending = b''
+        self.started = time.time()
+        self.last_beat = None
+        self.stopped = None
+        self.killed = False
+
+# message kind => fn(*args), see subscribe():
+_subscribers = dict()
+_notify = None
+
+def subscribe(kind, fn):
+    ' call fn(*args) for publish(kind, *args) of other workers. '
+    _subscribers[kind] = fn
+
+def publish(kind, *args):
+    ' pass message (json args) to the other workers, no-op if not run by Master. '
+    if _notify is not None:
+        _write(_notify, (json.dumps([kind] + list(args), ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8'))
+
+def heartbeat():
+    if _notify is not None:
+        _write(_notify, b'\n')
+
+def _write(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def attach(loop, notify, control):
+    '''
+    Set up pipes of worker to master in loop: notify for heartbeat() and
+    publish(), messages read from control are dispatched to subscribers.
+    '''
+    global _notify
+    _notify = notify
+    os.set_blocking(control, False)
+    received = [b'']
+    def on_readable():
+        try:
+            data = os.read(control, 65536)
+        except BlockingIOError:
+            return
+        if not data:
+            loop.remove_reader(control)
+            return
+        lines = (received[0] + data).split(b'\n')
+        received[0] = lines.pop()
+        for line in lines:
+            try:
+                msg = json.loads(line.decode('utf-8'))
+                fn = _subscribers.get(msg[0])
+                if fn is not None:
+                    fn(*msg[1:])
+            except Exception as e:
+                logging.exception(e)
+    loop.add_reader(control, on_readable)
+
+class Master(object):
+    '''
+    run_worker(sock, notify_fd, control_fd) serves until the worker is asked
+    to stop by SIGTERM, sock is None if workers bind with SO_REUSEPORT
+    themselves. The worker passes the fds to attach().
+    '''
+
+    def __init__(self, run_worker, workers, host, port, reuse_port=True, heartbeat_timeout=30, shutdown_timeout=10, startup_timeout=600):
+        self._run_worker = run_worker
+        self._count = workers
+        self._host = host
+        self._port = port
+        self._reuse_port = reuse_port
+        self._heartbeat_timeout = heartbeat_timeout
+        self._startup_timeout = startup_timeout
+        self._shutdown_timeout = shutdown_timeout
+        self._sock = None
+        self._workers = dict()
+        self._retiring = dict()
+        self._restart_queue = []
+        self._replacing = None
+        self._stopping = False
+
+    def _bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self._host, self._port))
+        sock.listen(1024)
+        sock.set_inheritable(True)
+        return sock
+
+    def _spawn(self, index):
+        r, w = os.pipe()
+        cr, cw = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # worker process:
+            os.close(r)
+            os.close(cw)
+            for worker in list(self._workers.values()) + list(self._retiring.values()):
+                os.close(worker.fd)
+                os.close(worker.control)
+            for sig in (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1):
+                signal.signal(sig, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                self._run_worker(self._sock, w, cr)
+            except BaseException as e:
+                logging.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(w)
+        os.close(cr)
+        os.set_blocking(r, False)
+        os.set_blocking(cw, False)
+        self._workers[pid] = Worker(pid, index, r, cw)
+        logging.info('worker %s started: pid %s' % (index, pid))
+        return pid
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _stop(self, pid):
+        ' ask worker to finish requests in flight and exit. '
+        worker = self._workers.pop(pid, None)
+        if worker is None:
+            return
+        worker.stopped = time.time()
+        self._retiring[pid] = worker
+        self._kill(pid, signal.SIGTERM)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            retired = pid in self._retiring
+            worker = self._workers.pop(pid, None) or self._retiring.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.fd)
+            os.close(worker.control)
+            logging.info('worker %s exited: pid %s, status %s' % (worker.index, pid, status))
+            if retired or self._stopping:
+                continue
+            if worker.index not in [w.index for w in self._workers.values()]:
+                self._spawn(worker.index)
+
+    def _beats(self, timeout):
+        workers = list(self._workers.values()) + list(self._retiring.values())
+        fds = dict((w.fd, w) for w in workers)
+        if not fds:
+            time.sleep(timeout)
+            return
+        controls = dict((w.control, w) for w in workers if w.pending)
+        readable, writable, _ = select.select(list(fds.keys()), list(controls.keys()), [], timeout)
+        for fd in writable:
+            self._flush(controls[fd])
+        now = time.time()
+        for fd in readable:
+            worker = fds[fd]
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            if not data:
+                continue
+            worker.last_beat = now
+            lines = (worker.received + data).split(b'\n')
+            worker.received = lines.pop()
+            for line in lines:
+                if line:
+                    self._broadcast(line + b'\n', worker)
+
+    def _broadcast(self, message, sender):
+        ' pass message of sender on to all other workers. '
+        for worker in list(self._workers.values()) + list(self._retiring.values()):
+            if worker is sender:
+                continue
+            worker.pending = worker.pending + message
+            self._flush(worker)
+            if len(worker.pending) > MAX_PENDING:
+                # it would serve stale caches:
+                logging.warning('worker %s not reading messages, kill pid %s' % (worker.index, worker.pid))
+                worker.pending = b''
+                self._kill(worker.pid, signal.SIGKILL)
+
+    def _flush(self, worker):
+        try:
+            n = os.write(worker.control, worker.pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            # worker exited:
+            worker.pending = b''
+            return
+        worker.pending = worker.pending[n:]
+
+    def _check_health(self):
+        now = time.time()
+        for worker in list(self._workers.values()):
+            if worker.killed:
+                continue
+            # the first heartbeat comes when the worker is ready to serve:
+            if worker.last_beat is None:
+                if now - worker.started > self._startup_timeout:
+                    logging.warning('worker %s not started, kill pid %s' % (worker.index, worker.pid))
+                    worker.killed = True
+                    self._kill(worker.pid, signal.SIGKILL)
+            elif now - worker.last_beat > self._heartbeat_timeout:
+                logging.warning('worker %s not responding, kill pid %s' % (worker.index, worker.pid))
+                worker.killed = True
+                self._kill(worker.pid, signal.SIGKILL)
+        for worker in list(self._retiring.values()):
+            if not worker.killed and now - worker.stopped > self._shutdown_timeout * 2:
+                logging.warning('worker %s not stopped, kill pid %s' % (worker.index, worker.pid))
+                worker.killed = True
+                self._kill(worker.pid, signal.SIGKILL)
+
+    def _rolling_restart(self):
+        # replace one worker at a time, the old one stops when the new one is ready:
+        if self._replacing is not None:
+            old, new = self._replacing
+            worker = self._workers.get(new)
+            if worker is None:
+                if old not in self._workers:
+                    self._replacing = None
+                    return
+                self._replacing = (old, self._spawn(self._workers[old].index))
+                return
+            if worker.last_beat is None:
+                return
+            self._stop(old)
+            self._replacing = None
+        while self._restart_queue:
+            old = self._restart_queue.pop(0)
+            if old in self._workers:
+                self._replacing = (old, self._spawn(self._workers[old].index))
+                return
+
+    def run(self):
+        if not self._reuse_port:
+            self._sock = self._bind()
+        flags = dict(stop=False, restart=False, usr1=False)
+        def on_stop(signum, frame):
+            flags['stop'] = True
+        def on_restart(signum, frame):
+            flags['restart'] = True
+        def on_usr1(signum, frame):
+            flags['usr1'] = True
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_restart)
+        signal.signal(signal.SIGUSR1, on_usr1)
+        logging.info('master started: pid %s, %s workers on %s:%s' % (os.getpid(), self._count, self._host, self._port))
+        for index in range(self._count):
+            self._spawn(index)
+        while self._workers or self._retiring:
+            self._beats(1.0)
+            self._reap()
+            if flags['stop'] and not self._stopping:
+                logging.info('stopping workers...')
+                self._stopping = True
+                for pid in list(self._workers.keys()):
+                    self._stop(pid)
+            if flags['restart'] and not self._stopping:
+                flags['restart'] = False
+                logging.info('rolling restart of workers...')
+                self._restart_queue = list(self._workers.keys())
+            if flags['usr1']:
+                flags['usr1'] = False
+                for pid in list(self._workers.keys()):
+                    self._kill(pid, signal.SIGUSR1)
+            if not self._stopping:
+                self._rolling_restart()
+            self._check_health()
+        if self._sock is not None:
+            self._sock.close()
+        logging.info('master stopped.')